@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for hash_db.py
+"""
+from argparse import ArgumentParser
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+
+import hash_db
+
+SCRIPT = Path(__file__).absolute().parent / 'hash_db.py'
+
+# Run in a separate process, so that peak RSS covers only loading and saving
+LOAD_SAVE = """
+import sys
+from argparse import Namespace
+from pathlib import Path
+from time import perf_counter
+sys.path.insert(0, {script_dir!r})
+import hash_db
+args = Namespace(jsondb={jsondb!r}, algorithm=None)
+db = hash_db.HashDatabase(args, Path({path!r}))
+start = perf_counter()
+db.load()
+loaded = perf_counter()
+if {save!r}:
+    db.changed = None
+    db.save()
+print(loaded - start if not {save!r} else perf_counter() - loaded)
+"""
+# Runs a script (or -c code) and reports its peak RSS on stderr. The
+# parent's memory would count towards ru_maxrss of its children, since
+# that survives exec, so read the high water mark of the new process.
+PEAK_RSS = """
+import atexit, runpy, sys
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss //= 1024
+    sys.stderr.write('\\npeak_rss_kib {}\\n'.format(rss))
+atexit.register(peak_rss)
+sys.argv = sys.argv[1:]
+if sys.argv[0] == '-c':
+    exec(compile(sys.argv[1], '<string>', 'exec'))
+else:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+def drop_cache(paths):
+    """
+    Asks the kernel to evict the given files from the page cache. Only clean
+    pages are dropped, so write the test data well before running this.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def collect_files(path: Path):
+    if path.is_file():
+        return [path]
+    return sorted(p for p in path.rglob('*') if p.is_file() and not p.is_symlink())
+
+def write_file(path: Path, size: int, rng):
+    with path.open('wb') as f:
+        while size > 0:
+            block = min(size, 1048576)
+            f.write(rng.getrandbits(block * 8).to_bytes(block, 'little'))
+            size -= block
+
+def make_small(root: Path, scale: float, rng):
+    """
+    Many small files, 1000 per directory
+    """
+    for i in range(max(int(10000 * scale), 1)):
+        directory = root / 'd{:05d}'.format(i // 1000)
+        if not i % 1000:
+            directory.mkdir()
+        write_file(directory / 'f{:07d}'.format(i), rng.randint(0, 4096), rng)
+
+def make_huge(root: Path, scale: float, rng):
+    """
+    A few large files
+    """
+    for i in range(max(int(4 * scale), 1)):
+        write_file(root / 'huge{:03d}.bin'.format(i), 64 * 1048576, rng)
+
+def make_deep(root: Path, scale: float, rng):
+    """
+    Deeply nested directories, with symlinks to files and directories
+    """
+    for branch in range(max(int(20 * scale), 1)):
+        directory = root / 'b{:04d}'.format(branch)
+        for depth in range(50):
+            directory = directory / 'n{:02d}'.format(depth)
+            directory.mkdir(parents=True)
+            write_file(directory / 'file', rng.randint(0, 65536), rng)
+            if depth % 10 == 9:
+                os.symlink('file', str(directory / 'file-link'))
+                os.symlink('..', str(directory / 'dir-link'))
+
+PROFILES = {
+    'small': make_small,
+    'huge': make_huge,
+    'deep': make_deep,
+}
+# Run in this order: each step expects the state left by the previous ones
+STEPS = ['init', 'status', 'update', 'verify', 'export', 'split', 'load', 'save']
+
+def tree_size(root: Path):
+    files = size = 0
+    for parent, _, _, entries in hash_db.scan_tree(root):
+        for entry in entries:
+            files += 1
+            size += entry.stat(follow_symlinks=False).st_size
+    return files, size
+
+def run(arguments):
+    """
+    Runs a Python script (or -c code) with arguments, returning (wall
+    time, peak RSS in KiB, stdout)
+    """
+    command = [sys.executable, '-c', PEAK_RSS] + arguments
+    start = perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    elapsed = perf_counter() - start
+    if process.returncode:
+        sys.stderr.write(stderr.decode(errors='replace'))
+        raise subprocess.CalledProcessError(process.returncode, arguments)
+    rss = int(stderr.rsplit(b'peak_rss_kib', 1)[1])
+    return elapsed, rss, stdout
+
+def modify_tree(root: Path, rng):
+    """
+    Touches and removes a few files and adds one, for status and update
+    """
+    files = sorted(p for p in root.rglob('*') if p.is_file() and not p.is_symlink()
+                   and p.name != 'hash_db.json')
+    for path in rng.sample(files, max(len(files) // 100, 1)):
+        os.utime(str(path))
+    for path in rng.sample(files, max(len(files) // 200, 1)):
+        if path.exists():
+            path.unlink()
+    write_file(root / 'added.bin', 1048576, rng)
+
+def suite_profile(name: str, args):
+    rng = random.Random(args.seed)
+    root = Path(mkdtemp(prefix='hash_db-bench-{}-'.format(name), dir=args.tmpdir))
+    try:
+        PROFILES[name](root, args.scale, rng)
+        files, size = tree_size(root)
+        options = [str(SCRIPT), '-d', str(root), '-J', str(args.jobs)]
+        results = {}
+        for step in args.steps:
+            if step == 'status':
+                modify_tree(root, rng)
+            if step in ('load', 'save'):
+                code = LOAD_SAVE.format(script_dir=str(SCRIPT.parent), jsondb=hash_db.DB_DEFAULT_FILENAME,
+                                        path=str(root), save=step == 'save')
+                _, rss, stdout = run(['-c', code])
+                elapsed = float(stdout)
+            elif step == 'split':
+                subdir = sorted(p for p in root.iterdir() if p.is_dir())
+                subdir = subdir[0] if subdir else root
+                elapsed, rss, _ = run(options + ['split', str(subdir)])
+                if subdir != root:
+                    (subdir / hash_db.DB_DEFAULT_FILENAME).unlink()
+            else:
+                elapsed, rss, _ = run(options + [step])
+            results[step] = {
+                'seconds': elapsed,
+                'peak_rss_kib': rss,
+                'files_per_second': files / elapsed if elapsed else None,
+                'bytes_per_second': size / elapsed if elapsed and step in ('init', 'verify') else None,
+            }
+            print('{:<6} {:<7} {:>9.3f} s {:>10.0f} files/s {:>8} MiB RSS'.format(
+                name, step, elapsed, results[step]['files_per_second'] or 0, rss // 1024))
+        return {'files': files, 'bytes': size, 'steps': results}
+    finally:
+        shutil.rmtree(str(root))
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the steps that got slower, or use more memory, than the
+    baseline by more than tolerance (a fraction), and returns how many
+    """
+    regressions = 0
+    for profile, result in sorted(results.items()):
+        for step, current in sorted(result['steps'].items()):
+            old = baseline.get(profile, {}).get('steps', {}).get(step)
+            if old is None:
+                continue
+            for key in ('seconds', 'peak_rss_kib'):
+                if old[key] and current[key] > old[key] * (1 + tolerance):
+                    regressions += 1
+                    print('REGRESSION {} {} {}: {:.3f} -> {:.3f} ({:+.0%})'.format(
+                        profile, step, key, old[key], current[key], current[key] / old[key] - 1))
+    return regressions
+
+def suite(args):
+    """
+    Generates synthetic trees and times each hash_db.py command on them
+    """
+    results = {}
+    for name in args.profiles:
+        results[name] = suite_profile(name, args)
+    if args.output:
+        with args.output.open('w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            exit('{} regressions against {}'.format(regressions, args.baseline))
+        print('No regressions against {}'.format(args.baseline))
+
+def read(args):
+    """
+    Hashes the files under args.path once with each read strategy and
+    prints the throughput of each
+    """
+    files = collect_files(args.path)
+    total = sum(f.stat().st_size for f in files)
+    if not total:
+        exit('No data to read under {}'.format(args.path))
+    algorithm = hash_db.HashAlgorithm(args.algorithm)
+    print('{} files, {:.1f} MiB, {}, chunk size {}, readahead {}'.format(
+        len(files), total / 1048576, algorithm.name, args.chunk_size, args.readahead))
+    for strategy in args.strategies:
+        reader = hash_db.FileReader(strategy, args.chunk_size, args.readahead)
+        timings = []
+        for _ in range(args.repeat):
+            if args.cold:
+                drop_cache(files)
+            start = perf_counter()
+            for f in files:
+                hash = algorithm.new()
+                for chunk in reader.chunks(str(f)):
+                    hash.update(chunk)
+            timings.append(perf_counter() - start)
+        best = min(timings)
+        print('{:<10} {:>10.1f} MiB/s  ({:.3f} s best of {})'.format(
+            strategy, total / 1048576 / best, best, args.repeat))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers()
+
+    parser_read = subparsers.add_parser('read', help=('Compare the throughput of the '
+        'read strategies (--read-strategy) on existing files'))
+    parser_read.add_argument('path', type=Path, help='File or directory to read')
+    parser_read.add_argument('--strategies', type=lambda s: s.split(','),
+        default=hash_db.READ_STRATEGIES, help=('Comma-separated strategies to compare. '
+        'Default: {}'.format(','.join(hash_db.READ_STRATEGIES))))
+    parser_read.add_argument('-a', '--algorithm', default=hash_db.DEFAULT_HASH_ALGORITHM,
+        choices=sorted(hash_db.HASH_FUNCTIONS))
+    parser_read.add_argument('--chunk-size', type=hash_db.parse_size, default=hash_db.CHUNK_SIZE)
+    parser_read.add_argument('--readahead', type=hash_db.parse_size, default=0)
+    parser_read.add_argument('--repeat', type=int, default=3, help='Runs per strategy. Default: 3')
+    parser_read.add_argument('--cold', action='store_true', help=('Drop the files from '
+        'the page cache before each run, to measure disk rather than memory bandwidth'))
+    parser_read.set_defaults(func=read)
+
+    parser_suite = subparsers.add_parser('suite', help=('Time each command on '
+        'generated trees, and optionally compare against a baseline'))
+    parser_suite.add_argument('--profiles', type=lambda s: s.split(','), default=sorted(PROFILES),
+        help=('Comma-separated trees to generate: small (10000 files of up to 4 KiB), huge '
+        '(4 files of 64 MiB), deep (20 branches nested 50 levels, with symlinks). '
+        'Default: all'))
+    parser_suite.add_argument('--scale', type=float, default=1, help=('Multiply the number '
+        'of files in each tree, e.g. 100 for a million small files. Default: 1'))
+    parser_suite.add_argument('--steps', type=lambda s: s.split(','), default=STEPS,
+        help='Comma-separated steps to time. Default: {}'.format(','.join(STEPS)))
+    parser_suite.add_argument('-J', '--jobs', type=int, default=1)
+    parser_suite.add_argument('--seed', type=int, default=0)
+    parser_suite.add_argument('--tmpdir', help='Where to generate the trees')
+    parser_suite.add_argument('-o', '--output', type=Path, help=('Write the results as '
+        'JSON, e.g. to use as a baseline later'))
+    parser_suite.add_argument('--baseline', type=Path, help=('Results of an earlier run '
+        'to compare against; exits with an error if any step regressed'))
+    parser_suite.add_argument('--tolerance', type=float, default=0.1, help=('Fraction '
+        'by which a step may be slower, or use more memory, than the baseline. '
+        'Default: 0.1'))
+    parser_suite.set_defaults(func=suite)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('a command is required')
+    args.func(args)
@@ -1,77 +1,229 @@
 #!/usr/bin/env python3
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ctypes
+from ctypes.util import find_library
 from enum import Enum
-from fnmatch import fnmatch
+from errno import EINVAL, ENOSPC
+from fnmatch import translate
+from functools import partial
+import gzip
 import hashlib
+from io import FileIO
+from itertools import islice
 import json
-from mmap import mmap, ACCESS_READ
-from os import fsdecode, fsencode, lstat, readlink, stat_result, getenv
+from mmap import mmap, ACCESS_READ, PAGESIZE
+import os
+from os import fsdecode, fsencode, lstat, readlink, stat_result, getenv, sep
 from os.path import normpath
 from pathlib import Path
 import re
+from select import select
+import shutil
+import sqlite3
 from stat import S_ISLNK, S_ISREG
-from sys import stderr, exit
+from struct import Struct
+from sys import stderr, stdin, exit, intern
+import threading
+from time import monotonic, sleep, time
+from zlib import crc32
 
 try:
-    from scandir import walk
+    from scandir import scandir
 except ImportError:
-    from os import walk
+    from os import scandir
 
-#TODO add argument to choose hash function? then also store in db? or just check format/length of hashes?
-#TODO also add check when loading database that hash function specified matches hashes in db
-#HASH_FUNCTION = hashlib.sha512
-HASH_FUNCTION = hashlib.sha256 
+# Optional, for fast non-cryptographic change detection
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+class ChecksumHash:
+    """
+    hashlib-style wrapper around a checksum function with the signature
+    of zlib.crc32(data, value)
+    """
+    digest_size = 4
+    block_size = 1
+
+    def __init__(self, name, function, data=b''):
+        self.name = name
+        self.function = function
+        self.value = 0
+        self.update(data)
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(self.digest_size, 'big')
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+# Name -> constructor taking optional initial data. Variable-length
+# digests (shake_*) have no fixed-size hex form, so they're left out.
+HASH_FUNCTIONS = {
+    name: partial(hashlib.new, name)
+    for name in hashlib.algorithms_available
+    if not name.startswith('shake_')
+}
+HASH_FUNCTIONS['crc32'] = partial(ChecksumHash, 'crc32', crc32)
+if crc32c is not None:
+    HASH_FUNCTIONS['crc32c'] = partial(ChecksumHash, 'crc32c', crc32c.crc32c)
+if xxhash is not None:
+    for name in ('xxh64', 'xxh3_64', 'xxh3_128'):
+        if hasattr(xxhash, name):
+            HASH_FUNCTIONS[name] = getattr(xxhash, name)
+DEFAULT_HASH_ALGORITHM = 'sha256'
 
-HASH_NAME = HASH_FUNCTION().name
-HASH_FILENAME = HASH_NAME.upper() + 'SUM'
+class HashAlgorithm:
+    """
+    A hash function from HASH_FUNCTIONS, along with what is derived from
+    it: the name of its SUM file and the pattern matching its hex digests.
+    """
+    def __init__(self, name):
+        if name not in HASH_FUNCTIONS:
+            message = "Unknown or unavailable hash algorithm '{}'. Available: {}"
+            raise ValueError(message.format(name, ', '.join(sorted(HASH_FUNCTIONS))))
+        self.name = name
+        self.new = HASH_FUNCTIONS[name]
+        self.digest_size = self.new().digest_size
+        self.filename = name.upper() + 'SUM'
+        self.pattern = re.compile(r'^[0-9a-fA-F]{' + str(self.digest_size * 2) + '}$')
+        self.empty_digest = self.new(b'').digest()
+
+    def __eq__(self, other):
+        return isinstance(other, HashAlgorithm) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+def parse_algorithms(value: str):
+    """
+    Argument type for --algorithm: comma-separated algorithm names
+    """
+    try:
+        return [HashAlgorithm(name.strip()) for name in value.split(',')]
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+EXPORT_FORMATS = ['gnu', 'bsd']
+# Uncompressed bytes per gzip member of a compressed export
+MANIFEST_MEMBER_SIZE = 1048576
 #TODO why is this here. why not use arg.jsondb with a default value set in argparser?
 DB_DEFAULT_FILENAME = getenv('HASH_DB_DEFAULT_FILE') if getenv('HASH_DB_DEFAULT_FILE') else 'hash_db.json'
-# fnmatch patterns, specifically:
-#TODO remove after add specification of specific hash file to import from
-IMPORT_FILENAME_PATTERNS = [
-    DB_DEFAULT_FILENAME,
-    HASH_FILENAME,
-    HASH_FILENAME + '.asc',
-    '*.' + HASH_NAME + 'sum',
-    '*.' + HASH_NAME + 'sum.asc',
-    'DIGESTS',
-    'DIGESTS.asc'
-]
-# 16 MiB, rounded down to a multiple of the hash's block size
-CHUNK_SIZE = int(16777216 / HASH_FUNCTION().block_size) * HASH_FUNCTION().block_size
-# Mostly used for importing from saved hash files
-EMPTY_FILE_HASH = HASH_FUNCTION(b'').hexdigest()
+
+def import_filename_patterns(algorithm: HashAlgorithm):
+    """
+    fnmatch patterns of the files that 'import' reads, for the given
+    algorithm
+    """
+    #TODO remove after add specification of specific hash file to import from
+    return [
+        DB_DEFAULT_FILENAME,
+        algorithm.filename,
+        algorithm.filename + '.asc',
+        '*.' + algorithm.name + 'sum',
+        '*.' + algorithm.name + 'sum.asc',
+        'DIGESTS',
+        'DIGESTS.asc'
+    ]
+
+# 16 MiB, a multiple of the block size of every supported hash
+CHUNK_SIZE = 16777216
+READ_STRATEGIES = ['readinto', 'fadvise', 'direct', 'mmap']
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+def parse_size(value: str) -> int:
+    """
+    Argument type for byte counts: an integer with an optional binary
+    suffix, e.g. '16M' or '1.5g'
+    """
+    value = value.strip()
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower())
+    try:
+        if multiplier:
+            return int(float(value[:-1]) * multiplier)
+        return int(value)
+    except ValueError:
+        raise ArgumentTypeError('invalid size: {!r}'.format(value))
+
+# Partial hashes used by 'verify --mode quick|sampled': mode -> (number of
+# blocks, block size). Blocks are spread evenly over the file, always
+# including the first and last bytes; 'quick' covers the first and last MiB.
+PARTIAL_HASH_MODES = {
+    'quick': (2, 1048576),
+    'sampled': (32, 131072),
+}
+VERIFY_MODES = ['full'] + sorted(PARTIAL_HASH_MODES)
 SURROGATE_ESCAPES = re.compile(r'([\udc80-\udcff])')
-HASH_PATTERN = re.compile(r'^[0-9a-fA-F]{' + str(HASH_FUNCTION().digest_size * 2) + '}$')
 
 ADDED_COLOR = '\033[01;32m'
 REMOVED_COLOR = '\033[01;34m'
 MODIFIED_COLOR = '\033[01;31m'
 NO_COLOR = '\033[00m'
 
+# Database filenames with these suffixes are stored in SQLite; anything
+# else is a single JSON document
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
 # 1: 'version' field added
 # 2: entry 'type' field added; symlinks now treated correctly
-DATABASE_VERSION = 2
+# 3: entry 'dev', 'ino' and 'mtime_ns' fields added; used to reuse hashes
+#    of renamed, moved or hardlinked files
+# 4: 'dirs' field added, holding the mtime and entry count of each directory
+# 5: entry 'quick_hash' and 'sampled_hash' fields added
+# 6: 'algorithms' field added; entry 'hashes' field added, holding the
+#    digests of any algorithms after the first
+# 7: entry 'verified' field added, the time of its last successful full
+#    verification; 'verify_started' field added, set while a verify runs
+# 8: 'tree' field added, holding the Merkle digest of each directory
+# 9: 'snapshot' field added, identifying the JSON snapshot that a
+#    '-journal' file of later changes applies to
+DATABASE_VERSION = 9
+
+def parse_hash_lines(data: bytes, algorithm: HashAlgorithm):
+    """
+    Yields (filename, hash) for each line of a hash file in the format
+    written by e.g. sha512sum, skipping lines that don't hold a hash of
+    the given algorithm
+    """
+    for line in data.splitlines():
+        pieces = fsdecode(line).strip().split('  ', 1)
+        if len(pieces) < 2 or not algorithm.pattern.match(pieces[0]):
+            continue
+        yield normpath(pieces[1]).replace('\\\\', '\\'), pieces[0]
 
-def read_saved_hashes(hash_file: Path) -> dict:
+def read_saved_hashes(hash_file: Path, algorithm: HashAlgorithm) -> dict:
     hashes = {}
     with hash_file.open('rb') as f:
-        for line in f:
-            pieces = fsdecode(line).strip().split('  ', 1)
-            if not HASH_PATTERN.match(pieces[0]):
-                continue
-            filename, file_hash = normpath(pieces[1]).replace('\\\\', '\\'), pieces[0]
+        for filename, file_hash in parse_hash_lines(f.read(), algorithm):
             file_path = (hash_file.parent / filename).absolute()
             hashes[file_path] = file_hash
     return hashes
 
+def compile_patterns(patterns):
+    """
+    Returns a function matching a filename against any of the given
+    fnmatch patterns, with a single regular expression
+    """
+    return re.compile('|'.join('(?:{})'.format(translate(pattern)) for pattern in patterns)).match
+
 #TODO remove after add specification of specific hash file to import from. or could this be useful if you are aggregating several dirs, some of which have hashsum files in them but not all?
-def find_external_hash_files(path: Path):
-    for dirpath_str, _, filenames in walk(str(path)):
-        dirpath = Path(dirpath_str).absolute()
-        for filename in filenames:
-            if any(fnmatch(filename, pattern) for pattern in IMPORT_FILENAME_PATTERNS):
-                yield dirpath / filename
+def find_external_hash_files(path: Path, patterns):
+    match = compile_patterns(patterns)
+    for parent, _, _, files in scan_tree(str(path)):
+        dirpath = path / parent
+        for dir_entry in files:
+            if match(dir_entry.name):
+                yield dirpath / dir_entry.name
 
 def find_hash_db_r(args, path: Path) -> Path:
     #TODO: don't search directories - use import for that?? or just require hashdb to be in root of data dir if you don't specify otherwise
@@ -94,94 +246,1644 @@ def find_hash_db(args, path: Path):
         raise FileNotFoundError(message.format(args.jsondb, path))
     return hash_db_path
 
-def split_path(path: Path):
-    """
-    :param path: Filesystem path
-    :return: path pieces
-    """
-    return path.parts[1:]
+def split_relpath(relpath: str):
+    """
+    :param relpath: Path relative to a database root, as used for keys
+    :return: 2-tuple of (parent directory, base name); the parent of
+      entries in the root directory is ''
+    """
+    parent, _, name = relpath.rpartition(sep)
+    return parent, name
+
+def join_relpath(parent: str, name: str):
+    return parent + sep + name if parent else name
+
+def sample_ranges(size: int, mode: str):
+    """
+    :param size: File size
+    :param mode: Key of PARTIAL_HASH_MODES
+    :return: list of (offset, length) pairs read for the partial hash,
+      or None if they would cover the whole file
+    """
+    count, block_size = PARTIAL_HASH_MODES[mode]
+    if size <= count * block_size:
+        return None
+    step = (size - block_size) / (count - 1)
+    return [(round(i * step), block_size) for i in range(count)]
+
+class SampledHash:
+    """
+    Computes a partial hash from the chunks of a sequential pass over
+    the whole file, by hashing the parts of each chunk that fall into
+    the (sorted, non-overlapping) ranges from sample_ranges
+    """
+    def __init__(self, algorithm, ranges):
+        self.hash = algorithm.new()
+        self.ranges = ranges
+        self.index = 0
+
+    def update(self, offset: int, chunk):
+        end = offset + len(chunk)
+        while self.index < len(self.ranges):
+            start, length = self.ranges[self.index]
+            if start >= end:
+                break
+            low, high = max(start, offset), min(start + length, end)
+            if high > low:
+                self.hash.update(chunk[low - offset:high - offset])
+            if start + length > end:
+                break
+            self.index += 1
+
+    def digest(self):
+        return self.hash.digest()
+
+def scan_tree(root: str):
+    """
+    Walks the directory tree below root using scandir. Subdirectories are
+    recognized from the entry type returned with the listing, so the walk
+    itself only stats directories; files are returned as DirEntry objects
+    whose stat() result is cached, and callers stat only the files they
+    need to. Like os.walk, symlinks to directories are not followed and
+    unreadable directories are skipped.
+
+    Yields a 4-tuple for each directory:
+    [0] its path relative to root, '' for root itself
+    [1] its lstat result, taken before reading the listing
+    [2] the number of names in it, including subdirectories
+    [3] a list of DirEntry objects for everything in it that isn't
+        a directory
+    """
+    try:
+        stack = [('', root, lstat(root))]
+    except FileNotFoundError:
+        return
+    while stack:
+        parent, dirpath, dir_st = stack.pop()
+        files = []
+        count = 0
+        try:
+            dir_entries = scandir(dirpath)
+        except OSError:
+            continue
+        for dir_entry in dir_entries:
+            count += 1
+            if dir_entry.is_dir():
+                if not dir_entry.is_symlink():
+                    try:
+                        st = dir_entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    stack.append((join_relpath(parent, dir_entry.name), dir_entry.path, st))
+                continue
+            files.append(dir_entry)
+        yield parent, dir_st, count, files
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(size) < 1024 or unit == 'TiB':
+            break
+        size /= 1024
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{:d} B'.format(int(size))
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+class Metrics:
+    """
+    Counts the files and bytes hashed by a command and the time spent
+    reading and hashing them, and reports progress on stderr while
+    hashing. Bytes are counted per chunk by the worker threads, so
+    progress moves during large files too.
+
+    read_time and hash_time are summed over all threads; their ratio
+    tells whether a run is disk-bound or CPU-bound.
+    """
+    def __init__(self, stream=stderr, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.files = self.bytes = 0
+        self.read_time = self.hash_time = 0.0
+        self.results = {}
+        self.label = None
+        self.done = self.total_files = self.total_bytes = 0
+
+    def begin(self, label: str, total_files: int, total_bytes: int):
+        """
+        Starts reporting progress of a hashing pass over total_files
+        files, expected to read total_bytes bytes (the sizes stored in
+        the database, used for the ETA)
+        """
+        with self.lock:
+            self.label = label
+            self.done = 0
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.pass_start = self.last_report = monotonic()
+            self.pass_bytes = self.bytes
+
+    def read(self, count: int, seconds: float):
+        with self.lock:
+            self.bytes += count
+            self.read_time += seconds
+        self.report()
+
+    def hashed(self, seconds: float):
+        with self.lock:
+            self.hash_time += seconds
+
+    def file_done(self):
+        """
+        Call from the main thread as each file of the current pass finishes
+        """
+        with self.lock:
+            self.files += 1
+            self.done += 1
+        self.report()
+
+    def progress(self) -> str:
+        elapsed = monotonic() - self.pass_start
+        done_bytes = self.bytes - self.pass_bytes
+        rate = done_bytes / elapsed if elapsed > 0 else 0
+        line = '{} {} of {} files, {} of {}, {}/s'.format(
+            self.label, self.done, self.total_files, format_size(done_bytes),
+            format_size(self.total_bytes), format_size(rate))
+        if rate and self.done < self.total_files:
+            remaining = max(self.total_bytes - done_bytes, 0)
+            line += ', ETA {}'.format(format_duration(remaining / rate))
+        return line
+
+    def report(self, force=False):
+        if self.stream is None or self.label is None:
+            return
+        with self.lock:
+            now = monotonic()
+            if not force and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            # Pad over leftovers of a longer previous line
+            self.stream.write('\r{:<79}'.format(self.progress()))
+            self.stream.flush()
+
+    def end(self):
+        """
+        Prints the final progress line of the current pass
+        """
+        if self.label is not None:
+            self.report(force=True)
+            if self.stream is not None:
+                self.stream.write('\n')
+            self.label = None
+
+    def summary(self, command: str) -> dict:
+        elapsed = monotonic() - self.start
+        summary = {
+            'command': command,
+            'elapsed_seconds': elapsed,
+            'files': self.files,
+            'bytes': self.bytes,
+            'files_per_second': self.files / elapsed if elapsed > 0 else 0,
+            'bytes_per_second': self.bytes / elapsed if elapsed > 0 else 0,
+            'read_seconds': self.read_time,
+            'hash_seconds': self.hash_time,
+            'bound': None,
+        }
+        if self.read_time or self.hash_time:
+            summary['bound'] = 'io' if self.read_time > self.hash_time else 'cpu'
+        summary.update(('{}_files'.format(name), count) for name, count in sorted(self.results.items()))
+        return summary
+
+    def write(self, filename: Path, command: str):
+        """
+        Writes the summary as JSON, or as a Prometheus textfile (for
+        the node exporter's textfile collector) if filename ends in
+        .prom. Replaces the file atomically, so collectors never see a
+        partial one.
+        """
+        summary = self.summary(command)
+        if filename.suffix == '.prom':
+            lines = []
+            for key, value in summary.items():
+                if key == 'command':
+                    continue
+                labels = 'command="{}"'.format(command)
+                if key == 'bound':
+                    if value is None:
+                        continue
+                    labels += ',bound="{}"'.format(value)
+                    value = 1
+                name = 'hash_db_' + key
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+            lines.append('# TYPE hash_db_last_run_timestamp_seconds gauge')
+            lines.append('hash_db_last_run_timestamp_seconds{{command="{}"}} {}'.format(command, time()))
+            text = '\n'.join(lines) + '\n'
+        else:
+            text = json.dumps(summary, indent=4, sort_keys=True) + '\n'
+        temp = filename.with_name(filename.name + '.tmp')
+        with temp.open('w') as f:
+            f.write(text)
+        os.replace(str(temp), str(filename))
+
+class Throttle:
+    """
+    Paces reads so that background runs leave disk bandwidth for other
+    work. Shared by all worker threads; each caller sleeps until its
+    share of the budget is available, outside of the lock.
+
+    bytes_per_sec and files_per_sec cap throughput and file opens (IOPS).
+    With adaptive, the duration of each read is also tracked as a fast
+    and a slow moving average; when the fast one rises well above the
+    slow one (the disk is getting busier), a delay is added after every
+    read, doubling while latency stays high and halving once it drops.
+    """
+    # Fast average above this multiple of the slow one means contention
+    LATENCY_FACTOR = 2
+    MIN_DELAY = 0.001
+    MAX_DELAY = 1
+
+    def __init__(self, bytes_per_sec=None, files_per_sec=None, adaptive=False):
+        self.bytes_per_sec = bytes_per_sec
+        self.files_per_sec = files_per_sec
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+        self.next_read = self.next_file = monotonic()
+        self.fast_latency = self.slow_latency = None
+        self.delay = 0
+
+    @classmethod
+    def from_args(cls, args):
+        throttle = cls(
+            getattr(args, 'max_bytes_per_sec', None),
+            getattr(args, 'max_files_per_sec', None),
+            getattr(args, 'adaptive_throttle', False),
+        )
+        return throttle if throttle else None
+
+    def __bool__(self):
+        return bool(self.bytes_per_sec or self.files_per_sec or self.adaptive)
+
+    def reserve(self, attr: str, cost: float) -> float:
+        """
+        Books cost seconds on the named schedule, and returns how long
+        the caller has to wait for its turn
+        """
+        with self.lock:
+            now = monotonic()
+            start = max(getattr(self, attr), now)
+            setattr(self, attr, start + cost)
+            return start - now
+
+    def file(self):
+        """
+        Call before opening or stat'ing each file
+        """
+        if self.files_per_sec:
+            sleep(self.reserve('next_file', 1 / self.files_per_sec))
+
+    def read(self, count: int, latency: float):
+        """
+        Call after each read of count bytes, which took latency seconds
+        """
+        wait = 0
+        if self.bytes_per_sec:
+            wait = self.reserve('next_read', count / self.bytes_per_sec)
+        if self.adaptive and count:
+            wait += self.observe(latency / count)
+        if wait > 0:
+            sleep(wait)
+
+    def observe(self, latency: float) -> float:
+        """
+        Records the latency per byte of a read, and returns the delay to
+        add after it
+        """
+        with self.lock:
+            if self.slow_latency is None:
+                self.fast_latency = self.slow_latency = latency
+                return 0
+            self.fast_latency += (latency - self.fast_latency) * 0.3
+            self.slow_latency += (latency - self.slow_latency) * 0.01
+            if self.fast_latency > self.slow_latency * self.LATENCY_FACTOR:
+                self.delay = min(max(self.delay * 2, self.MIN_DELAY), self.MAX_DELAY)
+            else:
+                self.delay /= 2
+                if self.delay < self.MIN_DELAY:
+                    self.delay = 0
+            return self.delay
+
+class FileReader:
+    """
+    Reads file contents for hashing, yielding memoryviews of successive
+    chunks. Strategies:
+
+    readinto: read each chunk into a buffer that is reused for every file
+      read by the same thread, and hash it in place, without copies
+    fadvise: like readinto, but tell the kernel the file is read
+      sequentially, and drop each chunk from the page cache once it has
+      been hashed, so that large runs don't evict other data
+    direct: like fadvise, but open with O_DIRECT to bypass the page cache
+      altogether. Falls back to fadvise where O_DIRECT isn't supported.
+    mmap: map the whole file and copy chunks out of the mapping
+
+    With readahead, the kernel is asked (POSIX_FADV_WILLNEED) to start
+    fetching that many bytes past the current chunk while it's hashed.
+    All reads are paced by the optional Throttle, and counted in the
+    optional Metrics.
+    """
+    def __init__(self, strategy='readinto', chunk_size=CHUNK_SIZE, readahead=0, throttle=None,
+                 metrics=None):
+        if strategy not in READ_STRATEGIES:
+            raise ValueError('Unknown read strategy {!r}'.format(strategy))
+        self.strategy = strategy
+        # O_DIRECT needs whole pages
+        self.chunk_size = max(-(-chunk_size // PAGESIZE) * PAGESIZE, PAGESIZE)
+        self.readahead = readahead
+        self.advise = hasattr(os, 'posix_fadvise') and strategy in ('fadvise', 'direct')
+        self.throttle = throttle
+        self.metrics = metrics
+        self.local = threading.local()
+
+    def buffer(self):
+        """
+        Returns this thread's read buffer. It's an anonymous mapping, so
+        it is page-aligned as O_DIRECT requires.
+        """
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            buffer = self.local.buffer = mmap(-1, self.chunk_size)
+        return buffer
+
+    def record(self, count: int, start: float):
+        """
+        Accounts for a read of count bytes that began at start
+        """
+        seconds = monotonic() - start
+        if self.metrics is not None:
+            self.metrics.read(count, seconds)
+        if self.throttle:
+            self.throttle.read(count, seconds)
+
+    def open(self, path: str, direct: bool):
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        if direct:
+            flags |= os.O_DIRECT
+        return FileIO(os.open(path, flags), 'rb')
+
+    def chunks(self, path: str):
+        if self.throttle:
+            self.throttle.file()
+        if self.strategy == 'mmap':
+            yield from self.mmap_chunks(path)
+            return
+        direct = self.strategy == 'direct' and hasattr(os, 'O_DIRECT')
+        try:
+            f = self.open(path, direct)
+        except OSError as e:
+            if not direct or e.errno != EINVAL:
+                raise
+            direct = False
+            f = self.open(path, direct)
+        try:
+            fd = f.fileno()
+            if self.advise:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            view = memoryview(self.buffer())
+            offset = 0
+            while True:
+                if self.readahead and hasattr(os, 'posix_fadvise') and not direct:
+                    os.posix_fadvise(fd, offset + self.chunk_size, self.readahead, os.POSIX_FADV_WILLNEED)
+                start = monotonic()
+                try:
+                    count = f.readinto(view)
+                except OSError as e:
+                    # Some filesystems accept O_DIRECT at open but not on read,
+                    # so carry on with the same buffer through the page cache
+                    if not direct or offset or e.errno != EINVAL:
+                        raise
+                    f.close()
+                    direct = False
+                    f = self.open(path, direct)
+                    fd = f.fileno()
+                    continue
+                self.record(count, start)
+                if not count:
+                    break
+                yield view[:count]
+                if self.advise:
+                    os.posix_fadvise(fd, offset, count, os.POSIX_FADV_DONTNEED)
+                offset += count
+        finally:
+            f.close()
+
+    def mmap_chunks(self, path: str):
+        with open(path, 'rb') as f:
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as m:
+                while True:
+                    start = monotonic()
+                    chunk = m.read(self.chunk_size)
+                    self.record(len(chunk), start)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def ranges(self, path: str, ranges):
+        """
+        Yields the contents of each (offset, length) range of the file
+        """
+        if self.throttle:
+            self.throttle.file()
+        with open(path, 'rb') as f:
+            for offset, length in ranges:
+                start = monotonic()
+                f.seek(offset)
+                data = f.read(length)
+                self.record(len(data), start)
+                yield data
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+class Inotify:
+    """
+    Minimal inotify binding through ctypes, so that watching needs no
+    third-party package. Linux only.
+    """
+    EVENT = Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            self.raise_error('inotify_init1')
+
+    def raise_error(self, call, path=None):
+        errno = ctypes.get_errno()
+        raise OSError(errno, '{}: {}'.format(call, os.strerror(errno)), path)
+
+    def add_watch(self, path: str, mask: int=WATCH_MASK) -> int:
+        """
+        Returns the watch descriptor, the same one each time for the
+        same directory
+        """
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            self.raise_error('inotify_add_watch', path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float=None):
+        """
+        Waits up to timeout seconds for events, and returns a list of
+        (watch descriptor, mask, name) for those that are available
+        """
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1048576)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class HashEntryType(Enum):
+    TYPE_FILE = 0
+    TYPE_SYMLINK = 1
+
+class HashEntry:
+    # Millions of these are kept in memory, so avoid a __dict__ per
+    # entry. The path is stored relative to the database root, split
+    # into an interned parent directory (shared by all of its entries)
+    # and the base name; the hash is kept as raw digest bytes. Digests
+    # of the database's extra algorithms, if any, are in a dict of
+    # algorithm name -> digest.
+    __slots__ = (
+        'db', 'parent', 'name', 'size', 'mtime', 'digest', 'type', 'dev', 'ino', 'mtime_ns',
+        'quick_digest', 'sampled_digest', 'extra_digests', 'verified',
+    )
+
+    def __init__(self, db, parent, name, size=None, mtime=None, digest=None, type=None,
+                 dev=None, ino=None, mtime_ns=None, quick_digest=None, sampled_digest=None,
+                 extra_digests=None, verified=None):
+        self.db = db
+        self.parent = intern(parent)
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.type = type
+        self.dev = dev
+        self.ino = ino
+        self.mtime_ns = mtime_ns
+        self.quick_digest = quick_digest
+        self.sampled_digest = sampled_digest
+        self.extra_digests = extra_digests
+        self.verified = verified
+
+    @classmethod
+    def from_relpath(cls, db, relpath, **kwargs):
+        parent, name = split_relpath(relpath)
+        return cls(db, parent, name, **kwargs)
+
+    @property
+    def relpath(self):
+        return join_relpath(self.parent, self.name)
+
+    @property
+    def filename(self):
+        """
+        Absolute Path of this entry; built on demand
+        """
+        return self.db.path / self.relpath
+
+    @property
+    def hash(self):
+        return None if self.digest is None else self.digest.hex()
+
+    @hash.setter
+    def hash(self, value):
+        self.digest = None if value is None else bytes.fromhex(value)
+
+    def hash_contents(self, algorithms, st: stat_result=None, samplers=()):
+        """
+        Returns a list of raw digests of the file contents (or of the
+        link target, for symlinks), one per algorithm, computed in a
+        single read pass.
+
+        :param st: lstat result for the file. If omitted, the type and
+          size recorded in this entry are used, so callers that have just
+          updated them don't need another stat call.
+        :param samplers: SampledHash objects fed from the same pass, for
+          regular files
+        """
+        if st is None:
+            is_file = self.type == HashEntryType.TYPE_FILE
+            is_symlink = self.type == HashEntryType.TYPE_SYMLINK
+            size = self.size
+        else:
+            is_file, is_symlink, size = S_ISREG(st.st_mode), S_ISLNK(st.st_mode), st.st_size
+        if is_file:
+            if size > 0:
+                hashes = [algorithm.new() for algorithm in algorithms]
+                offset = 0
+                for chunk in self.db.reader.chunks(str(self.filename)):
+                    start = monotonic()
+                    for hash in hashes:
+                        hash.update(chunk)
+                    for sampler in samplers:
+                        sampler.update(offset, chunk)
+                    self.db.metrics.hashed(monotonic() - start)
+                    offset += len(chunk)
+                return [hash.digest() for hash in hashes]
+            else:
+                return [algorithm.empty_digest for algorithm in algorithms]
+        elif is_symlink:
+            # Links to regular files are hashed by the file's contents,
+            # so exports check out with sha256sum -c, which follows them
+            try:
+                target_st = os.stat(str(self.filename))
+            except OSError:
+                target_st = None
+            if target_st is not None and S_ISREG(target_st.st_mode):
+                return self.hash_contents(algorithms, target_st)
+            # For anything else, the link target will suffice as the
+            # "contents"
+            target = fsencode(readlink(str(self.filename)))
+            return [algorithm.new(target).digest() for algorithm in algorithms]
+
+    def hash_file(self, st: stat_result=None, samplers=()):
+        """
+        Returns the raw digest of the file contents with the database's
+        primary algorithm; see hash_contents.
+        """
+        digests = self.hash_contents(self.db.algorithms[:1], st, samplers)
+        return None if digests is None else digests[0]
+
+    def hash_samples(self, mode: str, st: stat_result=None):
+        """
+        Returns the raw digest of the blocks that sample_ranges selects
+        for the given partial hash mode. For files small enough to be
+        covered entirely, that's the same as the full hash.
+
+        :param st: as for hash_file
+        """
+        ranges = sample_ranges(self.size if st is None else st.st_size, mode)
+        if ranges is None:
+            return self.hash_file(st)
+        hash = self.db.algorithm.new()
+        for data in self.db.reader.ranges(str(self.filename), ranges):
+            start = monotonic()
+            hash.update(data)
+            self.db.metrics.hashed(monotonic() - start)
+        return hash.digest()
+
+    def partial_digest(self, mode: str):
+        return getattr(self, mode + '_digest')
+
+    def partial_samplers(self, size: int):
+        """
+        Returns a SampledHash for each partial hash mode that doesn't
+        cover a file of the given size entirely, keyed by mode; pass
+        them to hash_contents, then to update_partial_digests.
+        """
+        samplers = {}
+        for mode in PARTIAL_HASH_MODES:
+            ranges = sample_ranges(size, mode)
+            if ranges is not None:
+                samplers[mode] = SampledHash(self.db.algorithm, ranges)
+        return samplers
+
+    def update_partial_digests(self, samplers):
+        """
+        Stores the partial hashes after the full hash was computed with
+        the given samplers: small files reuse the full hash, large ones
+        take the samplers' digests, so no block is read twice.
+        """
+        for mode in PARTIAL_HASH_MODES:
+            if self.type != HashEntryType.TYPE_FILE:
+                digest = None
+            elif mode in samplers:
+                digest = samplers[mode].digest()
+            else:
+                digest = self.digest
+            setattr(self, mode + '_digest', digest)
+
+    def update_digests(self, st: stat_result=None):
+        samplers = {}
+        if self.type == HashEntryType.TYPE_FILE and (st is None or S_ISREG(st.st_mode)):
+            samplers = self.partial_samplers(self.size if st is None else st.st_size)
+        digests = self.hash_contents(self.db.algorithms, st, list(samplers.values()))
+        if digests is None:
+            self.digest = self.extra_digests = None
+        else:
+            self.digest = digests[0]
+            self.extra_digests = {
+                algorithm.name: digest
+                for algorithm, digest in zip(self.db.algorithms[1:], digests[1:])
+            } or None
+        self.update_partial_digests(samplers)
+
+    def digest_for(self, algorithm: HashAlgorithm):
+        """
+        Returns the raw digest for one of the database's algorithms, or
+        None if it isn't known (e.g. for imported hashes)
+        """
+        if algorithm == self.db.algorithm:
+            return self.digest
+        return (self.extra_digests or {}).get(algorithm.name)
+
+    def exists(self):
+        return self.filename.is_file() or self.filename.is_symlink()
+
+    def verify(self, st: stat_result=None):
+        return self.hash_file(st) == self.digest
+
+    def update_attrs(self, st: stat_result=None):
+        s = lstat(str(self.filename)) if st is None else st
+        self.size, self.mtime = s.st_size, s.st_mtime
+        self.dev, self.ino, self.mtime_ns = s.st_dev, s.st_ino, s.st_mtime_ns
+
+    def cache_key(self):
+        """
+        Identifies the on-disk inode and its contents without reading
+        them. Any two entries sharing a key (the same file under a new
+        name, or hardlinks) must have the same hash.
+
+        Returns None if the entry predates inode tracking.
+        """
+        if self.ino is None or self.mtime_ns is None:
+            return None
+        return (self.dev, self.ino, self.size, self.mtime_ns)
+
+    def to_dict(self):
+        """
+        Returns the stored fields of this entry, as saved in the database.
+        """
+        entry_data = {
+            'size': self.size,
+            'mtime': self.mtime,
+            'hash': self.hash,
+            'type': self.type.value,
+            'dev': self.dev,
+            'ino': self.ino,
+            'mtime_ns': self.mtime_ns,
+            'quick_hash': None if self.quick_digest is None else self.quick_digest.hex(),
+            'sampled_hash': None if self.sampled_digest is None else self.sampled_digest.hex(),
+            'verified': self.verified,
+        }
+        if self.extra_digests:
+            entry_data['hashes'] = {name: digest.hex() for name, digest in self.extra_digests.items()}
+        return entry_data
+
+    @classmethod
+    def from_dict(cls, db, relpath, entry_data):
+        entry = cls.from_relpath(
+            db,
+            relpath,
+            size=entry_data.get('size'),
+            mtime=entry_data.get('mtime'),
+            type=HashEntryType(entry_data.get('type')),
+            dev=entry_data.get('dev'),
+            ino=entry_data.get('ino'),
+            mtime_ns=entry_data.get('mtime_ns'),
+            verified=entry_data.get('verified'),
+        )
+        entry.hash = entry_data.get('hash')
+        for mode in PARTIAL_HASH_MODES:
+            value = entry_data.get(mode + '_hash')
+            setattr(entry, mode + '_digest', None if value is None else bytes.fromhex(value))
+        if entry_data.get('hashes'):
+            entry.extra_digests = {name: bytes.fromhex(value) for name, value in entry_data['hashes'].items()}
+        return entry
+
+    def copy_to(self, db, relpath):
+        """
+        Returns a copy of this entry belonging to another database,
+        stored there under relpath
+        """
+        return self.moved_to(db, *split_relpath(relpath))
+
+    def moved_to(self, db, parent, name):
+        """
+        Like copy_to, for callers that already have the path split
+        """
+        copy = self.__class__(db, parent, name)
+        for attr in self.__slots__[3:]:
+            setattr(copy, attr, getattr(self, attr))
+        return copy
+
+    def reuse_hash(self, other):
+        """
+        Takes the hash and type from an entry with the same cache key,
+        instead of reading the file again.
+        """
+        self.digest = other.digest
+        self.type = other.type
+        self.quick_digest = other.quick_digest
+        self.sampled_digest = other.sampled_digest
+        self.extra_digests = other.extra_digests
+
+    def update_type(self, st: stat_result=None):
+        if self.filename.is_symlink() if st is None else S_ISLNK(st.st_mode):
+            self.type = HashEntryType.TYPE_SYMLINK
+        else:
+            # Treat it as a file even if it's missing. This only occurs when
+            # importing from saved hashes.
+            self.type = HashEntryType.TYPE_FILE
+
+    def update(self, st: stat_result=None):
+        if st is None:
+            st = lstat(str(self.filename))
+        self.update_attrs(st)
+        self.update_type(st)
+        self.update_digests(st)
+
+    def __eq__(self, other):
+        if isinstance(other, stat_result):
+            return (
+                self.size == other.st_size and
+                self.mtime == other.st_mtime and
+                (
+                    (self.type == HashEntryType.TYPE_FILE and S_ISREG(other.st_mode))or
+                    (self.type == HashEntryType.TYPE_SYMLINK and S_ISLNK(other.st_mode))
+                )
+            )
+        return super().__eq__(other)
+
+    # Equality with anything but a stat_result is identity, so hash by
+    # identity too; hashing only the base name puts every 'index.html'
+    # in the same bucket
+    __hash__ = object.__hash__
+
+class EntryStore(MutableMapping):
+    """
+    Mapping of path relative to the database root -> HashEntry.
+
+    Entries are grouped by parent directory, so lookups while walking a
+    directory don't need to build a path for every file, and per-directory
+    operations only touch the entries they need. The directories form a
+    tree (subdirs), so a subtree can be found without looking at entries
+    outside of it.
+    """
+    def __init__(self):
+        # parent directory -> {base name: HashEntry}
+        self.dirs = {}
+        # directory -> set of names of its subdirectories with entries
+        # somewhere below them
+        self.subdirs = {}
+        self.count = 0
+
+    def lookup(self, parent, name):
+        return self.dirs.get(parent, {}).get(name)
+
+    def add(self, entry):
+        names = self.dirs.get(entry.parent)
+        if names is None:
+            names = self.dirs[entry.parent] = {}
+            self.link(entry.parent)
+        if entry.name not in names:
+            self.count += 1
+        names[entry.name] = entry
+
+    def link(self, directory: str):
+        """
+        Adds directory and its ancestors to the tree of directories
+        """
+        while directory:
+            parent, name = split_relpath(directory)
+            children = self.subdirs.setdefault(parent, set())
+            if name in children:
+                break
+            children.add(name)
+            directory = parent
+
+    def unlink(self, directory: str):
+        """
+        Removes directory, and any ancestors left without entries or
+        subdirectories, from the tree of directories
+        """
+        while directory and directory not in self.dirs and not self.subdirs.get(directory):
+            self.subdirs.pop(directory, None)
+            parent, name = split_relpath(directory)
+            self.subdirs[parent].discard(name)
+            directory = parent
+
+    def subtree(self, directory: str=''):
+        """
+        Yields the path of directory and of every directory below it that
+        has entries somewhere below it, in no particular order
+        """
+        if directory not in self.dirs and directory not in self.subdirs:
+            return
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            yield directory
+            for name in self.subdirs.get(directory, ()):
+                stack.append(join_relpath(directory, name))
+
+    def sorted_entries(self, directory: str=''):
+        """
+        Yields the entries at or below directory, in the order of a
+        sorted list of their paths split into components (i.e. that of
+        sorting absolute paths). Only the names within each directory
+        are sorted, which is close to linear when they were stored in
+        order already, as they are when loaded from either backend.
+        """
+        def listing(directory):
+            names = self.dirs.get(directory, {})
+            # A file sorts before a directory of the same name, as a
+            # path sorts before the longer paths it is a prefix of
+            items = sorted([(name, False) for name in names] +
+                           [(name, True) for name in self.subdirs.get(directory, ())])
+            for name, is_dir in items:
+                yield (join_relpath(directory, name), None) if is_dir else (None, names[name])
+
+        stack = [listing(directory)]
+        while stack:
+            for subdir, entry in stack[-1]:
+                if entry is not None:
+                    yield entry
+                else:
+                    stack.append(listing(subdir))
+                    break
+            else:
+                stack.pop()
+
+    def __getitem__(self, relpath):
+        entry = self.lookup(*split_relpath(relpath))
+        if entry is None:
+            raise KeyError(relpath)
+        return entry
+
+    def __setitem__(self, relpath, entry):
+        parent, name = split_relpath(relpath)
+        if (entry.parent, entry.name) != (parent, name):
+            raise ValueError('{} stored under {}'.format(entry.relpath, relpath))
+        self.add(entry)
+
+    def __delitem__(self, relpath):
+        parent, name = split_relpath(relpath)
+        names = self.dirs.get(parent, {})
+        del names[name]
+        self.count -= 1
+        if not names:
+            del self.dirs[parent]
+            self.unlink(parent)
+
+    def __contains__(self, relpath):
+        return self.lookup(*split_relpath(relpath)) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for parent, names in self.dirs.items():
+            for name in names:
+                yield join_relpath(parent, name)
+
+    def values(self):
+        for names in self.dirs.values():
+            yield from names.values()
+
+    def items(self):
+        for entry in self.values():
+            yield entry.relpath, entry
+
+def hash_new_entry(entry):
+    """
+    Worker for newly added files, whose attributes and type were
+    already filled in from the directory walk. Returns False if the
+    file disappeared between listing and hashing.
+    """
+    try:
+        entry.update_digests()
+    except FileNotFoundError:
+        # If file was removed between listing and processing,
+        # just treat it as if it never existed
+        # We have nothing to compare it to anyway
+        return False
+    return True
+
+def rehash_entry(item):
+    """
+    Worker for files whose size, mtime or type changed, taking an
+    (entry, lstat result) pair. Updates a copy of the entry, so a
+    checkpoint saved meanwhile never pairs the new size and mtime with
+    the old hash. Returns the copy and whether the hash changed.
+    """
+    entry, st = item
+    updated = entry.moved_to(entry.db, entry.parent, entry.name)
+    updated.update(st)
+    return updated, updated.digest != entry.digest
+
+def refresh_entry(item):
+    """
+    Worker for paths reported by watch, taking an (entry, lstat result)
+    pair. Like rehash_entry, updates a copy of the entry, and returns
+    the copy and whether the hash changed. Returns (None, None) if the
+    file disappeared before it was hashed, and (None, the error) if it
+    couldn't be read, leaving the entry as it was.
+    """
+    entry, st = item
+    updated = entry.moved_to(entry.db, entry.parent, entry.name)
+    try:
+        updated.update(st)
+    except FileNotFoundError:
+        return None, None
+    except OSError as e:
+        return None, e
+    return updated, updated.digest != entry.digest
+
+def digest_entry(item, algorithm=None, reader=None):
+    """
+    Worker for duplicate detection, taking an (entry, ranges) pair:
+    hashes the given (offset, length) ranges of the entry's file with
+    algorithm, or all of it if ranges is None. Returns None if the
+    file can't be read.
+    """
+    entry, ranges = item
+    hash = algorithm.new()
+    try:
+        if ranges is None:
+            chunks = reader.chunks(str(entry.filename))
+        else:
+            chunks = reader.ranges(str(entry.filename), ranges)
+        for chunk in chunks:
+            hash.update(chunk)
+    except OSError:
+        return None
+    return hash.digest()
+
+def read_hash_file(hash_file, algorithm=None, root=None, throttle=None):
+    """
+    Worker for import: parses a hash file, and lstats every file listed
+    in it that is inside root, the database directory.
+
+    Relative paths are resolved against the directory of the hash file,
+    wherever that is, so a hash file outside root can list files in it.
+
+    Returns a 2-tuple:
+    [0] dict of path relative to root -> (hex hash, lstat result, or
+        None if the file is missing)
+    [1] list of the paths listed that are outside root, and skipped
+    """
+    with open(str(hash_file), 'rb') as f:
+        data = f.read()
+    directory = str(hash_file.absolute().parent)
+    results = {}
+    skipped = []
+    for filename, file_hash in parse_hash_lines(data, algorithm):
+        relpath = os.path.relpath(os.path.join(directory, filename), root)
+        if relpath == os.pardir or relpath.startswith(os.pardir + sep) or os.path.isabs(relpath):
+            skipped.append(filename)
+            continue
+        if throttle:
+            throttle.file()
+        try:
+            st = lstat(os.path.join(root, relpath))
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        results[relpath] = file_hash, st
+    return results, skipped
+
+def match_recovered(item, index=None, algorithm=None, reader=None):
+    """
+    Worker for recover, taking a (path, lstat result) pair for a file
+    whose size matches at least one entry. Returns the list of entries
+    whose hash matches its contents, which is empty if none do or the
+    file can't be read.
+
+    If every candidate of that size has a stored quick hash, that is
+    checked first, so that large files matching nothing aren't read in
+    full.
+    """
+    path, st = item
+    candidates = index[st.st_size]
+    try:
+        ranges = sample_ranges(st.st_size, 'quick')
+        if ranges is not None and all(entry.quick_digest is not None for entry in candidates):
+            hash = algorithm.new()
+            for chunk in reader.ranges(path, ranges):
+                hash.update(chunk)
+            quick = hash.digest()
+            candidates = [entry for entry in candidates if entry.quick_digest == quick]
+            if not candidates:
+                return []
+        hash = algorithm.new()
+        for chunk in reader.chunks(path):
+            hash.update(chunk)
+    except OSError:
+        return []
+    digest = hash.digest()
+    return [entry for entry in candidates if entry.digest == digest]
+
+def expected_bytes(entry, mode: str) -> int:
+    """
+    Returns the number of bytes verify_entry should read for an entry,
+    according to its recorded size
+    """
+    if entry.type != HashEntryType.TYPE_FILE or not entry.size:
+        return 0
+    ranges = None
+    if mode != 'full' and entry.partial_digest(mode) is not None:
+        ranges = sample_ranges(entry.size, mode)
+    if ranges is None:
+        return entry.size
+    return sum(length for _, length in ranges)
+
+def verify_entry(item, update_mtimes=False):
+    """
+    Worker for verification, taking an (entry, mode) pair where mode is
+    one of VERIFY_MODES. Returns a (result, changed) pair: result is None
+    if the file is missing, otherwise whether its contents still match
+    the stored hash; changed is whether the entry was updated and needs
+    saving.
+
+    Partial modes fall back to the full hash for symlinks and for entries
+    without a stored partial hash. A successful full verification fills
+    in missing partial hashes, and records the time in entry.verified.
+    """
+    entry, mode = item
+    try:
+        st = lstat(str(entry.filename))
+    except FileNotFoundError:
+        return None, False
+    if not (S_ISREG(st.st_mode) or S_ISLNK(st.st_mode)):
+        return None, False
+    changed = False
+    expected = None if mode == 'full' else entry.partial_digest(mode)
+    if expected is not None and S_ISREG(st.st_mode):
+        if st.st_size != entry.size or entry.hash_samples(mode, st) != expected:
+            return False, False
+    else:
+        # Missing partial hashes are filled in from the same pass
+        fill_partial = (entry.type == HashEntryType.TYPE_FILE and entry.quick_digest is None and
+                        S_ISREG(st.st_mode))
+        samplers = entry.partial_samplers(st.st_size) if fill_partial else {}
+        if entry.hash_file(st, list(samplers.values())) != entry.digest:
+            return False, False
+        if fill_partial:
+            entry.update_partial_digests(samplers)
+        entry.verified = time()
+        changed = True
+    if update_mtimes:
+        attrs = (entry.size, entry.mtime, entry.dev, entry.ino, entry.mtime_ns)
+        entry.update_attrs(st)
+        changed = changed or attrs != (entry.size, entry.mtime, entry.dev, entry.ino, entry.mtime_ns)
+    return True, changed
+
+def fix_symlinks(db):
+    for entry in db.entries.values():
+        if entry.type is None:
+            entry.update_type()
+            if entry.type == HashEntryType.TYPE_SYMLINK:
+                entry.update()
+
+def add_inode_info(db):
+    # Only trust the current inode for files that look unchanged since
+    # they were hashed; anything else gets its inode on the next rehash
+    for entry in db.entries.values():
+        try:
+            st = lstat(str(entry.filename))
+        except FileNotFoundError:
+            continue
+        if entry == st:
+            entry.dev, entry.ino, entry.mtime_ns = st.st_dev, st.st_ino, st.st_mtime_ns
+
+# Intended usage: at version i, you need to run all
+# upgrade functions in range(i, DATABASE_VERSION)
+db_upgrades = [
+    None,
+    fix_symlinks,
+    add_inode_info,
+    None,
+    None,
+    None,
+    None,
+    None,
+    None,
+]
+
+def detect_algorithm(db):
+    """
+    Databases before version 6 don't record their hash algorithm. It was
+    sha256 unless the source was edited to use sha512, so tell them apart
+    by digest size.
+    """
+    for entry in db.entries.values():
+        if entry.digest is not None:
+            for name in (DEFAULT_HASH_ALGORITHM, 'sha512'):
+                algorithm = HashAlgorithm(name)
+                if len(entry.digest) == algorithm.digest_size:
+                    return algorithm
+            break
+    return HashAlgorithm(DEFAULT_HASH_ALGORITHM)
+
+class JsonObjectStream:
+    """
+    Incremental parser for a JSON object, reading the text in chunks.
+    Members are decoded one at a time, so nested objects can be walked
+    without holding the whole document (or its parsed form) in memory.
+    """
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, f, chunk_size=1048576):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        data = self.f.read(self.chunk_size)
+        if data:
+            self.buffer = self.buffer[self.pos:] + data
+            self.pos = 0
+        else:
+            self.eof = True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or None at
+        the end of the input.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return None
+            self.fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {!r} at offset {}, found {!r}'.format(char, self.pos, found))
+        self.pos += 1
+
+    def value(self):
+        """
+        Decodes the next complete JSON value.
+        """
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            # A number running up to the end of the buffer may continue
+            # in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def keys(self):
+        """
+        Yields each key of the object at the current position. The
+        caller must consume the corresponding value (with value(),
+        keys() or items()) before advancing to the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            separator = self.peek()
+            self.pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError('Expected \',\' or \'}\' at offset {}, found {!r}'.format(self.pos - 1, separator))
+
+    def items(self):
+        for key in self.keys():
+            yield key, self.value()
+
+    def lines(self):
+        """
+        Yields the rest of the input after the current position as
+        lines, each with its line end (except for an unterminated last
+        line)
+        """
+        pending = self.buffer[self.pos:]
+        self.buffer, self.pos = '', 0
+        while True:
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+            data = '' if self.eof else self.f.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                if pending:
+                    yield pending
+                return
+            pending += data
+
+def sync_directory(path: Path):
+    """
+    Makes a rename in the directory durable, where the platform allows
+    """
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class JsonStorage:
+    """
+    The original storage format: one JSON document holding the database
+    metadata and a 'files' object keyed by relative path.
+
+    Both directions stream the 'files' object one entry at a time. The
+    output is identical to json.dump(..., sort_keys=True) of the same
+    content.
+
+    The document (the snapshot) is replaced atomically: written to a
+    temporary file, synced, and renamed over the old one. Saves of a
+    loaded database only append the changed entries to a journal file
+    next to it, one JSON line per save, which load replays; once the
+    journal grows past JOURNAL_RATIO of the snapshot's size, a new
+    snapshot is written and the journal removed. The journal starts with
+    the 'snapshot' token of the snapshot it applies to, so it is ignored
+    after a snapshot was written without removing it (e.g. by a crash
+    in between, or by an older version of this script). A torn last line
+    from a crash while appending is ignored as well.
+    """
+    JOURNAL_RATIO = 0.25
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.journal = filename.with_name(filename.name + '-journal')
+
+    def load(self, db):
+        #TODO FIXME fails if not a json file
+        #TODO do some basic checking of json structure to make sure it's not only a json file, but also correctly constructed for this program?
+        meta = {}
+        if str(self.filename) == '-':
+            f = open(stdin.fileno(), encoding='utf-8', closefd=False)
+        else:
+            f = self.filename.open(encoding='utf-8')
+        with f:
+            stream = JsonObjectStream(f)
+            for key in stream.keys():
+                if key == 'files':
+                    for relpath, entry_data in stream.items():
+                        db.entries.add(HashEntry.from_dict(db, relpath, entry_data))
+                else:
+                    meta[key] = stream.value()
+            db.load_meta(meta)
+            if str(self.filename) == '-':
+                # The journal may follow the snapshot, as sent by e.g.
+                # cat hash_db.json hash_db.json-journal
+                self.replay(db, self.journal_records(stream.lines()))
+        if str(self.filename) != '-':
+            self.replay(db, self.read_journal())
+
+    @staticmethod
+    def journal_records(lines):
+        """
+        Yields the complete records in lines of journal text, starting
+        with the header
+        """
+        for line in lines:
+            if not line.endswith('\n'):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+    def read_journal(self):
+        try:
+            f = self.journal.open(encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            yield from self.journal_records(f)
+
+    def replay(self, db, records):
+        header = next(records, None)
+        if header is None or db.snapshot is None or header.get('snapshot') != db.snapshot:
+            return
+        for record in records:
+            for relpath, entry_data in record['files'].items():
+                if entry_data is not None:
+                    db.entries.add(HashEntry.from_dict(db, relpath, entry_data))
+                elif relpath in db.entries:
+                    del db.entries[relpath]
+            meta = db.meta()
+            meta.update(record['meta'])
+            for key in ('dirs', 'tree'):
+                for directory, value in record[key].items():
+                    if value is None:
+                        meta[key].pop(directory, None)
+                    else:
+                        meta[key][directory] = value
+            db.load_meta(meta)
+
+    def write_files(self, f, db):
+        f.write('{')
+        for i, relpath in enumerate(sorted(db.entries)):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(relpath, ensure_ascii=False))
+            f.write(': ')
+            f.write(json.dumps(db.entries[relpath].to_dict(), ensure_ascii=False, sort_keys=True))
+        f.write('}')
+
+    def save(self, db, incremental=True):
+        """
+        :param incremental: whether the changes since loading may be
+          appended to the journal, rather than writing a snapshot
+        """
+        if (incremental and db.changed is not None and db.tree_changes is not None and
+                db.snapshot is not None and self.filename.is_file()):
+            self.append(db)
+            if self.journal.stat().st_size < self.filename.stat().st_size * self.JOURNAL_RATIO:
+                return
+        self.write_snapshot(db)
 
-class HashEntryType(Enum):
-    TYPE_FILE = 0
-    TYPE_SYMLINK = 1
+    def append(self, db):
+        header = next(self.read_journal(), None)
+        if header is None or header.get('snapshot') != db.snapshot:
+            # No journal yet, or one left over from an older snapshot
+            mode, lines = 'w', [json.dumps({'snapshot': db.snapshot})]
+        else:
+            mode, lines = 'a', []
+            self.truncate_torn_record()
+        files = {relpath: db.entries[relpath].to_dict() for relpath in db.changed if relpath in db.entries}
+        files.update((relpath, None) for relpath in db.deleted)
+        meta = db.meta()
+        record = {
+            'files': files,
+            'meta': {key: value for key, value in meta.items() if key not in ('dirs', 'tree')},
+            'dirs': {directory: db.dirs.get(directory) for directory in db.dirs_changes},
+            'tree': {directory: db.tree.get(directory) for directory in db.tree_changes},
+        }
+        lines.append(json.dumps(record, ensure_ascii=False, sort_keys=True))
+        with self.journal.open(mode, encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
 
-class HashEntry:
-    def __init__(self, filename, size=None, mtime=None, hash=None, type=None):
-        # In memory, "filename" should be an absolute Path
-        self.filename = filename
-        self.size = size
-        self.mtime = mtime
-        self.hash = hash
-        self.type = type
+    def truncate_torn_record(self):
+        """
+        Removes a partial last line, left by a crash while appending, so
+        the next record starts on a line of its own
+        """
+        with self.journal.open('r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - CHUNK_SIZE, 0)
+                f.seek(start)
+                newline = f.read(position - start).rfind(b'\n')
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                f.truncate(position)
 
-    def hash_file(self):
-        if self.filename.is_file():
-            if lstat(str(self.filename)).st_size > 0:
-                with self.filename.open('rb') as f:
-                    with mmap(f.fileno(), 0, access=ACCESS_READ) as m:
-                        hash = HASH_FUNCTION()
-                        for chunk in iter(lambda: m.read(CHUNK_SIZE), b''):
-                            hash.update(chunk)
+    def write_snapshot(self, db):
+        db.snapshot = os.urandom(16).hex()
+        meta = db.meta()
+        temp = self.filename.with_name(self.filename.name + '-new')
+        with temp.open('w', encoding='utf-8') as f:
+            f.write('{')
+            for i, key in enumerate(sorted(list(meta) + ['files'])):
+                if i:
+                    f.write(', ')
+                f.write(json.dumps(key, ensure_ascii=False))
+                f.write(': ')
+                if key == 'files':
+                    self.write_files(f, db)
+                else:
+                    f.write(json.dumps(meta[key], ensure_ascii=False, sort_keys=True))
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(temp), str(self.filename))
+        sync_directory(self.filename.parent)
+        # The snapshot holds everything in the journal now, and has a new
+        # token, so a journal surviving a crash here is ignored anyway
+        try:
+            self.journal.unlink()
+        except FileNotFoundError:
+            pass
 
-                        return hash.hexdigest()
-            else:
-                return EMPTY_FILE_HASH
-        elif self.filename.is_symlink():
-            # The link target will suffice as the "contents"
-            target = readlink(str(self.filename))
-            return HASH_FUNCTION(fsencode(target)).hexdigest()
+class SqliteStorage:
+    """
+    Stores entries in an SQLite table indexed by relative path. Saving
+    only writes the entries that were added, changed or removed since
+    the database was loaded, in a single transaction. The directory
+    mtimes and Merkle digests have tables of their own, keyed by
+    directory, so they are updated in place as well; only the few
+    scalar fields are kept in 'meta'.
 
-    def exists(self):
-        return self.filename.is_file() or self.filename.is_symlink()
+    Entries are not loaded lazily: every command reads the whole table
+    into memory, as with JSON, since update, status and verify visit
+    every entry anyway.
 
-    def verify(self):
-        return self.hash_file() == self.hash
+    Paths are stored as the raw bytes from os.fsencode, so filenames
+    that aren't valid UTF-8 survive the round trip. Entry fields that
+    don't have their own column are kept as JSON in 'extra'.
+    """
+    COLUMNS = ('size', 'mtime', 'hash', 'type', 'dev', 'ino', 'mtime_ns')
+    # Fields of HashDatabase.meta() stored in their own tables
+    KEYED = ('dirs', 'tree')
 
-    def update_attrs(self):
-        s = lstat(str(self.filename))
-        self.size, self.mtime = s.st_size, s.st_mtime
+    def __init__(self, filename: Path):
+        self.filename = filename
 
-    def update_type(self):
-        if self.filename.is_symlink():
-            self.type = HashEntryType.TYPE_SYMLINK
-        else:
-            # Treat it as a file even if it's missing. This only occurs when
-            # importing from saved hashes.
-            self.type = HashEntryType.TYPE_FILE
+    def connect(self):
+        conn = sqlite3.connect(str(self.filename))
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path BLOB PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, type INTEGER, '
+            'dev INTEGER, ino INTEGER, mtime_ns INTEGER, extra TEXT'
+            ') WITHOUT ROWID'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS dirs ('
+            'path BLOB PRIMARY KEY, mtime_ns INTEGER NOT NULL, count INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS tree (path BLOB PRIMARY KEY, digest TEXT NOT NULL) WITHOUT ROWID')
+        return conn
 
-    def update(self):
-        self.update_attrs()
-        self.update_type()
-        self.hash = self.hash_file()
+    def row_to_entry(self, db, row):
+        entry_data = dict(zip(self.COLUMNS, row[1:-1]))
+        if row[-1]:
+            entry_data.update(json.loads(row[-1]))
+        return HashEntry.from_dict(db, fsdecode(row[0]), entry_data)
 
-    def __eq__(self, other):
-        if isinstance(other, stat_result):
-            return (
-                self.size == other.st_size and
-                self.mtime == other.st_mtime and
-                (
-                    (self.type == HashEntryType.TYPE_FILE and S_ISREG(other.st_mode))or
-                    (self.type == HashEntryType.TYPE_SYMLINK and S_ISLNK(other.st_mode))
-                )
-            )
-        return super().__eq__(other)
+    def entry_to_row(self, db, entry):
+        entry_data = entry.to_dict()
+        row = [fsencode(entry.relpath)]
+        row.extend(entry_data.pop(column) for column in self.COLUMNS)
+        row.append(json.dumps(entry_data, sort_keys=True) if entry_data else None)
+        return row
 
-    def __hash__(self):
-        return hash(self.filename)
+    def load(self, db):
+        conn = self.connect()
+        try:
+            meta = {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM meta')}
+            if 'version' not in meta:
+                raise ValueError('{} is not a hash database'.format(self.filename))
+            meta['dirs'] = {
+                fsdecode(path): [mtime_ns, count]
+                for path, mtime_ns, count in conn.execute('SELECT * FROM dirs')
+            }
+            meta['tree'] = {fsdecode(path): digest for path, digest in conn.execute('SELECT * FROM tree')}
+            db.load_meta(meta)
+            # Iterating over the cursor streams rows instead of
+            # materializing the whole table first
+            for row in conn.execute('SELECT * FROM files'):
+                db.entries.add(self.row_to_entry(db, row))
+        finally:
+            conn.close()
 
-def fix_symlinks(db):
-    for entry in db.entries.values():
-        if entry.type is None:
-            entry.update_type()
-            if entry.type == HashEntryType.TYPE_SYMLINK:
-                entry.update()
+    @staticmethod
+    def save_keyed(conn, table, values, changes, row):
+        """
+        Writes the rows of a table keyed by directory: all of values if
+        changes is None, otherwise only the directories in changes,
+        deleting those no longer in values. row turns a value into the
+        tuple of columns after the path.
+        """
+        if changes is None:
+            conn.execute('DELETE FROM {}'.format(table))
+            changes = values
+        for directory in changes:
+            if directory in values:
+                columns = (fsencode(directory),) + row(values[directory])
+                conn.execute('INSERT OR REPLACE INTO {} VALUES ({})'.format(
+                    table, ', '.join('?' * len(columns))), columns)
+            else:
+                conn.execute('DELETE FROM {} WHERE path = ?'.format(table), (fsencode(directory),))
 
-# Intended usage: at version i, you need to run all
-# upgrade functions in range(i, DATABASE_VERSION)
-db_upgrades = [
-    None,
-    fix_symlinks,
-]
+    def save(self, db, incremental=True):
+        conn = self.connect()
+        try:
+            with conn:
+                stored_version = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+                full = not incremental or db.changed is None or stored_version is None
+                placeholders = ', '.join('?' * (len(self.COLUMNS) + 2))
+                insert = 'INSERT OR REPLACE INTO files VALUES ({})'.format(placeholders)
+                if full:
+                    conn.execute('DELETE FROM files')
+                    changed = db.entries.values()
+                else:
+                    changed = (db.entries[relpath] for relpath in db.changed if relpath in db.entries)
+                    conn.executemany('DELETE FROM files WHERE path = ?', (
+                        (fsencode(relpath),) for relpath in db.deleted
+                    ))
+                conn.executemany(insert, (self.entry_to_row(db, entry) for entry in changed))
+                self.save_keyed(conn, 'dirs', db.dirs, None if full else db.dirs_changes, tuple)
+                self.save_keyed(conn, 'tree', db.tree, None if full else db.tree_changes,
+                                lambda digest: (digest,))
+                conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', (
+                    (key, json.dumps(value)) for key, value in db.meta().items() if key not in self.KEYED
+                ))
+        finally:
+            conn.close()
+
+def storage_for(filename: Path):
+    if filename.suffix.lower() in SQLITE_SUFFIXES:
+        return SqliteStorage(filename)
+    return JsonStorage(filename)
 
 class HashDatabase:
     def __init__(self, args, path: Path):
@@ -189,149 +1891,497 @@ class HashDatabase:
         try:
             self.path = find_hash_db(args, path).parent
         except FileNotFoundError:
-            self.path = path
-        self.entries = {}
+            self.path = path.absolute()
+        self.entries = EntryStore()
         self.version = DATABASE_VERSION
         self.info_url = "https://github.com/julowe/hash-db"
+        # The first algorithm is used for change detection and verification;
+        # digests of any others are computed in the same pass and kept in
+        # HashEntry.extra_digests
+        self.algorithms = getattr(args, 'algorithm', None) or [HashAlgorithm(DEFAULT_HASH_ALGORITHM)]
+        # Start time of an unfinished verify run, for --resume
+        self.verify_started = None
+        self.throttle = Throttle.from_args(args)
+        self.metrics = Metrics()
+        self.reader = FileReader(
+            getattr(args, 'read_strategy', 'readinto'),
+            getattr(args, 'chunk_size', CHUNK_SIZE),
+            getattr(args, 'readahead', 0),
+            self.throttle,
+            self.metrics,
+        )
+        # Directory relative path -> [mtime_ns, number of names in it],
+        # as of the last update
+        self.dirs = {}
+        # Keys of entries added/modified and removed since loading, so
+        # that storage backends can write only what changed. None means
+        # that everything must be rewritten.
+        self.changed = None
+        self.deleted = set()
+        # Directory relative path -> hex Merkle digest of its contents
+        # (see update_tree), and the directories whose digests are out of
+        # date. The tree is brought up to date before saving.
+        self.tree = {}
+        self.stale_dirs = set()
+        # Directories whose tree digests changed since loading, or None
+        # if the whole tree was rebuilt; and those whose dirs record did
+        self.tree_changes = set()
+        self.dirs_changes = set()
+        # Token of the JSON snapshot loaded or last written; see JsonStorage
+        self.snapshot = None
+
+    def set_entry(self, entry):
+        self.entries.add(entry)
+        self.mark_changed(entry)
+
+    def remove_entry(self, entry):
+        relpath = entry.relpath
+        del self.entries[relpath]
+        self.stale_dirs.add(entry.parent)
+        if self.changed is not None:
+            self.changed.discard(relpath)
+            self.deleted.add(relpath)
+
+    def mark_changed(self, entry):
+        self.stale_dirs.add(entry.parent)
+        if self.changed is not None:
+            relpath = entry.relpath
+            self.changed.add(relpath)
+            self.deleted.discard(relpath)
+
+    @property
+    def algorithm(self):
+        return self.algorithms[0]
+
+    def is_database_file(self, filename: str):
+        #TODO expand to allow list of ignore files
+        # Also skips SQLite's '-journal' and '-wal' files
+        if filename == self.args.jsondb or filename.startswith(self.args.jsondb + '-'):
+            return True
+        # and the files written by export, which would otherwise be hashed
+        # by the next update
+        for algorithm in self.algorithms or ():
+            if filename in (algorithm.filename, algorithm.filename + '.gz', algorithm.filename + '.gz.idx'):
+                return True
+        return False
+
+    def relpath(self, path: Path):
+        """
+        Returns the key for an absolute path inside this database
+        """
+        return str(path.relative_to(self.path))
 
-    def save(self):
-        filename = self.path / self.args.jsondb
-        data = {
+    def meta(self):
+        """
+        Returns the database-level fields, i.e. everything saved
+        alongside the entries.
+        """
+        return {
+            'algorithms': [algorithm.name for algorithm in self.algorithms],
+            'dirs': self.dirs,
             'info_url': self.info_url,
+            'snapshot': self.snapshot,
+            'tree': self.tree,
+            'verify_started': self.verify_started,
             'version': self.version,
-            'files': {
-                str(entry.filename.relative_to(self.path)): {
-                    'size': entry.size,
-                    'mtime': entry.mtime,
-                    'hash': entry.hash,
-                    'type': entry.type.value,
-                }
-                for entry in self.entries.values()
-            }
         }
-        with filename.open('w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, sort_keys=True)
+
+    def load_meta(self, data):
+        self.version = data['version']
+        self.dirs = data.get('dirs', {})
+        self.verify_started = data.get('verify_started')
+        self.tree = data.get('tree', {})
+        self.snapshot = data.get('snapshot')
+        if 'algorithms' in data:
+            self.algorithms = [HashAlgorithm(name) for name in data['algorithms']]
+        else:
+            self.algorithms = None
+        #self.info_url = data['info_url'] #TODO decide if bumping version of DB is right, or if a check if this field exists before trying to load makes more sense. prob latter... or both? for now not as important, not reading in will just overwrite this field that isn't set by any other version of the script (yet)
+
+    def hash_entries(self, func, entries):
+        """
+        Calls func on each entry, spreading the work over args.jobs
+        worker threads. hashlib releases the GIL while hashing large
+        buffers, and file reads release it as well, so threads keep
+        both the CPU cores and the disk queues busy.
+
+        Only a bounded number of entries is in flight at any time.
+        Yields (entry, result) pairs in completion order; callers
+        merge the results into self.entries from the calling thread.
+        """
+        jobs = max(getattr(self.args, 'jobs', 1) or 1, 1)
+        if jobs == 1:
+            for entry in entries:
+                yield entry, func(entry)
+            return
+        entries = iter(entries)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(func, entry): entry for entry in islice(entries, jobs * 2)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = pending.pop(future)
+                    for next_entry in islice(entries, 1):
+                        pending[executor.submit(func, next_entry)] = next_entry
+                    yield entry, future.result()
+
+    def directory_digest(self, directory: str):
+        """
+        Returns the hex Merkle digest of a directory: a hash, with the
+        primary algorithm, over the sorted names in it, with the type and
+        digest of each file and the digest of each subdirectory. Uses
+        self.tree for the subdirectories, so they must be up to date.
+
+        Returns None for directories without entries below them.
+        """
+        names = self.entries.dirs.get(directory, {})
+        subdirs = self.entries.subdirs.get(directory, ())
+        if not names and not subdirs:
+            return None
+        hash = self.algorithm.new()
+        for name, is_dir in sorted([(name, False) for name in names] + [(name, True) for name in subdirs]):
+            if is_dir:
+                hash.update(b'D' + fsencode(name) + b'\0')
+                hash.update(bytes.fromhex(self.tree[join_relpath(directory, name)]))
+            else:
+                entry = names[name]
+                kind = b'L' if entry.type == HashEntryType.TYPE_SYMLINK else b'F'
+                hash.update(kind + fsencode(name) + b'\0')
+                hash.update(entry.digest or b'')
+        return hash.hexdigest()
+
+    def update_tree(self):
+        """
+        Recomputes the Merkle digests of the directories whose entries
+        changed, and of their ancestors, deepest first. Rebuilds the
+        whole tree if it may be missing or out of date (new, upgraded or
+        imported databases).
+        """
+        if self.changed is None or (not self.tree and len(self.entries)):
+            self.tree = {}
+            self.tree_changes = None
+            stale = set(self.entries.subtree(''))
+        else:
+            stale = set()
+            for directory in self.stale_dirs:
+                while directory not in stale:
+                    stale.add(directory)
+                    if not directory:
+                        break
+                    directory = split_relpath(directory)[0]
+        for directory in sorted(stale, key=lambda directory: directory.count(sep) + bool(directory), reverse=True):
+            digest = self.directory_digest(directory)
+            if digest is None:
+                self.tree.pop(directory, None)
+            else:
+                self.tree[directory] = digest
+            if self.tree_changes is not None:
+                self.tree_changes.add(directory)
+        self.stale_dirs = set()
+
+    def compare(self, other):
+        """
+        Compares the entries of this database with those of another one
+        for the same tree, e.g. of a replica, by their Merkle digests: a
+        subtree is only descended into if its digests differ, so the
+        work is proportional to the differences (and comparing identical
+        databases only looks at the root).
+
+        Returns a 3-tuple of sets of relative paths:
+        [0] entries only in this database
+        [1] entries only in other
+        [2] entries whose type or digest differs
+        """
+        if other.algorithm != self.algorithm:
+            raise ValueError('Can not compare {} digests with {} digests'.format(
+                self.algorithm.name, other.algorithm.name))
+        self.update_tree()
+        other.update_tree()
+        only_here, only_there, different = set(), set(), set()
+        stack = ['']
+        while stack:
+            directory = stack.pop()
+            if self.tree.get(directory) == other.tree.get(directory):
+                continue
+            if directory not in other.tree:
+                only_here.update(entry.relpath for entry in self.entries.sorted_entries(directory))
+                continue
+            if directory not in self.tree:
+                only_there.update(entry.relpath for entry in other.entries.sorted_entries(directory))
+                continue
+            names = self.entries.dirs.get(directory, {})
+            other_names = other.entries.dirs.get(directory, {})
+            for name in names.keys() | other_names.keys():
+                entry, other_entry = names.get(name), other_names.get(name)
+                if other_entry is None:
+                    only_here.add(entry.relpath)
+                elif entry is None:
+                    only_there.add(other_entry.relpath)
+                elif (entry.type, entry.digest) != (other_entry.type, other_entry.digest):
+                    different.add(entry.relpath)
+            subdirs = self.entries.subdirs.get(directory, set()) | other.entries.subdirs.get(directory, set())
+            stack.extend(join_relpath(directory, name) for name in subdirs)
+        return only_here, only_there, different
+
+    def save(self, filename: Path=None):
+        self.update_tree()
+        if filename is None:
+            filename = self.path / self.args.jsondb
+            storage_for(filename).save(self)
+            # The file now matches memory, so later saves only need
+            # what changes from here on
+            self.changed = set()
+            self.deleted = set()
+            self.tree_changes = set()
+            self.dirs_changes = set()
+        else:
+            storage_for(filename).save(self, incremental=False)
 
     def split(self, subdir: Path):
         if subdir.is_file():
             raise NotADirectoryError(subdir)
         subdir = subdir.absolute()
-        copy = self.__class__(self.path)
+        copy = self.__class__(self.args, self.path)
         copy.path = subdir
-        pieces = split_path(subdir)
-        prefix_len = len(pieces)
-        for path, item in self.entries.items():
-            entry_path_pieces = split_path(path)
-            if pieces[:prefix_len] == entry_path_pieces[:prefix_len]:
-                copy.entries[path] = item
+        copy.algorithms = self.algorithms
+        copy.throttle = self.throttle
+        copy.metrics = self.metrics
+        copy.reader = self.reader
+        prefix = self.relpath(subdir)
+        if prefix == '.':
+            prefix = ''
+        copy.copy_subtree(self, prefix, '')
         return copy
 
-    def load(self):
-        filename = find_hash_db(self.args, self.path)
-        #TODO FIXME fails if not a json file
-        with filename.open(encoding='utf-8') as f:
-            data = json.load(f)
-        #TODO do some basic checking of json structure to make sure it's not only a json file, but also correctly constructed for this program?
-        self.version = data['version']
-        #self.info_url = data['info_url'] #TODO decide if bumping version of DB is right, or if a check if this field exists before trying to load makes more sense. prob latter... or both? for now not as important, not reading in will just overwrite this field that isn't set by any other version of the script (yet)
-        for filename, entry_data in data['files'].items():
-            entry = HashEntry((self.path / filename).absolute())
-            entry.size = entry_data.get('size')
-            entry.mtime = entry_data.get('mtime')
-            entry.hash = entry_data.get('hash')
-            entry.type = HashEntryType(entry_data.get('type'))
-            self.entries[entry.filename] = entry
+    def copy_subtree(self, other, source='', target=''):
+        """
+        Copies the entries of database other at or below directory source
+        into this database, re-rooted below directory target, without
+        rehashing anything. Only the directories of that subtree are
+        visited (see EntryStore.subtree), so the cost is proportional to
+        its size rather than that of either database. The directory
+        mtimes recorded by update are carried over as well.
+
+        Returns the number of entries copied.
+        """
+        count = 0
+        strip = len(source) + 1 if source else 0
+        for directory in other.entries.subtree(source):
+            rest = directory[strip:] if directory != source else ''
+            new_parent = join_relpath(target, rest) if rest else target
+            for entry in other.entries.dirs.get(directory, {}).values():
+                self.set_entry(entry.moved_to(self, new_parent, entry.name))
+                count += 1
+            if directory in other.dirs:
+                self.dirs[new_parent] = other.dirs[directory]
+                self.dirs_changes.add(new_parent)
+        return count
+
+    def load(self, filename: Path=None, upgrade=True):
+        """
+        :param filename: database file to load, '-' for JSON (and its
+          journal, if any, right after it) on standard input. Default:
+          args.jsondb in self.path or the closest parent directory having
+          one.
+        :param upgrade: run the upgrades for older database versions; they
+          may look at the files on disk, so only skip them for databases
+          describing another copy of the tree
+        """
+        if filename is None:
+            filename = find_hash_db(self.args, self.path)
+        storage_for(filename).load(self)
+        if self.algorithms is None:
+            self.algorithms = [detect_algorithm(self)]
+        requested = getattr(self.args, 'algorithm', None)
+        if requested and requested != self.algorithms:
+            message = '{} uses {}, not {}. Create a new database to change algorithms'
+            raise ValueError(message.format(
+                filename,
+                ','.join(algorithm.name for algorithm in self.algorithms),
+                ','.join(algorithm.name for algorithm in requested),
+            ))
+        # Upgrades may touch any entry, so only track changes for
+        # databases that were already current
+        self.changed = set() if self.version == DATABASE_VERSION else None
+        if not upgrade:
+            return
         for i in range(self.version, DATABASE_VERSION):
-            db_upgrades[i](self)
+            if db_upgrades[i] is not None:
+                db_upgrades[i](self)
         self.version = DATABASE_VERSION
 
-    def import_hashes(self, filename):
+    def import_hashes(self, filenames):
         """
-        Imports a hash file created by e.g. sha512sum, and populates
+        Imports hash files created by e.g. sha512sum, and populates
         the database with this data. Examines each file to obtain the
         size and mtime information.
 
-        Returns the number of file hashes imported.
+        Hash files are parsed, and the files they list stat'ed, by
+        args.jobs worker threads, but merged into the database in the
+        given order, so a file listed in several hash files gets the
+        hash from the last one, as if they were imported one by one.
+
+        Yields a 3-tuple for each hash file: the file, the number of
+        file hashes imported from it, and the list of paths in it that
+        were skipped for being outside the database.
         """
-        hashes = read_saved_hashes(filename)
-        i = 0
-        for i, (file_path, hash) in enumerate(hashes.items(), 1):
-            entry = HashEntry(file_path)
-            entry.hash = hash
-            entry.update_type()
-            try:
-                entry.update_attrs()
-            except FileNotFoundError:
-                # Not much else to do here.
-                pass
-            self.entries[entry.filename] = entry
-        return i
+        filenames = list(filenames)
+        worker = partial(read_hash_file, algorithm=self.algorithm, root=str(self.path),
+                         throttle=self.throttle)
+        indexes = {filename: i for i, filename in enumerate(filenames)}
+        done = {}
+        next_index = 0
+        for filename, result in self.hash_entries(worker, filenames):
+            done[indexes[filename]] = filename, result
+            while next_index in done:
+                filename, (hashes, skipped) = done.pop(next_index)
+                next_index += 1
+                for relpath, (hash, st) in hashes.items():
+                    entry = HashEntry.from_relpath(self, relpath)
+                    entry.hash = hash
+                    entry.update_type(st)
+                    if st is not None:
+                        entry.update_attrs(st)
+                    # Otherwise not much else to do here.
+                    self.set_entry(entry)
+                yield filename, len(hashes), skipped
 
     def _find_changes(self):
         """
         Walks the filesystem. Identifies noteworthy files -- those
         that were added, removed, or changed (size, mtime or type).
 
-        Returns a 3-tuple of sets of HashEntry objects:
-        [0] added files
-        [1] removed files
-        [2] modified files
+        Each file is stat'ed at most once, during the directory walk. With
+        --trust-dir-mtimes, files already in the database aren't stat'ed at
+        all if their directory's mtime and number of names match what was
+        recorded by the last update. Creating, removing or renaming files
+        changes a directory's mtime, but writing to a file doesn't, so
+        content changes in such directories go unnoticed.
+
+        Returns a 4-tuple:
+        [0] set of added files, with their attributes and type filled in
+        [1] set of removed files
+        [2] dict of modified files, mapped to their current lstat result
+        [3] dict of directory -> [mtime_ns, number of names], as seen
+            during this walk
 
         self.entries is not modified; this method only reports changes.
         """
         added = set()
-        modified = set()
+        modified = {}
         existing_files = set()
-        for dirpath_str, _, filenames in walk(str(self.path)):
-            dirpath = Path(dirpath_str)
-            for filename in filenames:
-                #TODO either add SHA(256|512)SUM or expand to allow list of ignore files
-                if filename == self.args.jsondb:
+        dirs = {}
+        trust_dir_mtimes = getattr(self.args, 'trust_dir_mtimes', False)
+        for parent, dir_st, count, files in scan_tree(str(self.path)):
+            dirs[parent] = [dir_st.st_mtime_ns, count]
+            unchanged_dir = trust_dir_mtimes and self.dirs.get(parent) == dirs[parent]
+            names = self.entries.dirs.get(parent, {})
+            for dir_entry in files:
+                filename = dir_entry.name
+                if self.is_database_file(filename):
+                    continue
+                entry = names.get(filename)
+                if entry is not None and unchanged_dir:
+                    existing_files.add(entry)
                     continue
-                abs_filename = (dirpath / filename).absolute()
-                if abs_filename in self.entries:
-                    entry = self.entries[abs_filename]
+                try:
+                    st = dir_entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if not (S_ISREG(st.st_mode) or S_ISLNK(st.st_mode)):
+                    continue
+                if entry is not None:
                     existing_files.add(entry)
-                    st = lstat(str(abs_filename))
                     if entry != st:
-                        modified.add(entry)
+                        modified[entry] = st
                 else:
-                    try:
-                        entry = HashEntry(abs_filename)
-                        entry.update_attrs()
-                        added.add(entry)
-                    except FileNotFoundError:
-                        # If file was removed between listing and processing,
-                        # just treat it as if it never existed
-                        # We have nothing to compare it to anyway
-                        pass
+                    entry = HashEntry(self, parent, filename)
+                    entry.update_attrs(st)
+                    entry.update_type(st)
+                    added.add(entry)
         removed = set(self.entries.values()) - existing_files
-        return added, removed, modified
+        return added, removed, modified, dirs
+
+    def hash_cache(self):
+        """
+        Returns a dict mapping HashEntry.cache_key() to an entry
+        with a known hash, for every entry that has one.
+        """
+        cache = {}
+        for entry in self.entries.values():
+            key = entry.cache_key()
+            if key is not None and entry.digest is not None:
+                cache[key] = entry
+        return cache
 
-    def update(self):
+    def update(self, checkpoint=None, checkpoint_interval=300):
         """
         Walks the filesystem, adding and removing files from
         the database as appropriate.
 
+        Added files whose inode, size and mtime match a known entry
+        (renames, moves and hardlinks) reuse that entry's hash rather
+        than being read again.
+
+        :param checkpoint: called from this thread every checkpoint_interval
+          seconds while hashing, to save progress (e.g. self.save). Entries
+          are merged into the database as soon as they are hashed; the
+          directory mtimes are only replaced at the end, so an interrupted
+          run never lets --trust-dir-mtimes skip what it didn't get to.
+
         Returns a 3-tuple of sets of filenames:
         [0] added files
         [1] removed files
         [2] modified files
         """
-        added, removed, modified = self._find_changes()
+        added, removed, modified, dirs = self._find_changes()
+        # Built before removed entries are dropped, since a renamed
+        # file shows up as one removed and one added entry. Only
+        # needed (and worth its memory) when something was added.
+        cache = self.hash_cache() if added else {}
+        to_hash = []
+        # Entries sharing a cache key with an added entry that
+        # still needs hashing, e.g. several new hardlinks
+        same_inode = []
+        hashing = {}
+        for entry in added:
+            key = entry.cache_key()
+            if key in cache:
+                entry.reuse_hash(cache[key])
+            elif key is not None and key in hashing:
+                same_inode.append((entry, hashing[key]))
+            else:
+                if key is not None:
+                    hashing[key] = entry
+                to_hash.append(entry)
         # Make a new list of added files containing ones that
         # actually were added
-        added_real = set()
-        for entry in added:
-            # If file was removed between listing and processing,
-            # just treat it as if it never existed
-            # We have nothing to compare it to anyway
-            if entry.exists():
-                entry.update()
-                self.entries[entry.filename] = entry
-                added_real.add(entry)
+        added_real = added - set(to_hash) - {entry for entry, _ in same_inode}
         for entry in removed:
-            del self.entries[entry.filename]
+            self.remove_entry(entry)
+        for entry in added_real:
+            self.set_entry(entry)
+        if to_hash or modified:
+            self.metrics.begin(
+                'Hashed',
+                len(to_hash) + len(modified),
+                sum(entry.size or 0 for entry in to_hash) +
+                sum(st.st_size for st in modified.values()),
+            )
+        last_checkpoint = time()
+        for entry, exists in self.hash_entries(hash_new_entry, to_hash):
+            self.metrics.file_done()
+            if exists:
+                added_real.add(entry)
+                self.set_entry(entry)
+            if checkpoint is not None and time() - last_checkpoint >= checkpoint_interval:
+                checkpoint()
+                last_checkpoint = time()
+        for entry, other in same_inode:
+            if other in added_real:
+                entry.reuse_hash(other)
+                added_real.add(entry)
+                self.set_entry(entry)
         added = added_real
         # Entries will appear in 'modified' if the size, mtime or type
         # change. I've seen a lot of spurious mtime mismatches on vfat
@@ -339,74 +2389,548 @@ class HashDatabase:
         # as modified if the hash changes.
         #TODO add err output that this occured? or only if mtime changed and hash didn't?
         content_modified = set()
-        for entry in modified:
-            old_hash = entry.hash
-            entry.update()
-            if entry.hash != old_hash:
+        for _, (entry, hash_changed) in self.hash_entries(rehash_entry, modified.items()):
+            self.metrics.file_done()
+            self.set_entry(entry)
+            if hash_changed:
                 content_modified.add(entry)
+            if checkpoint is not None and time() - last_checkpoint >= checkpoint_interval:
+                checkpoint()
+                last_checkpoint = time()
+        self.metrics.end()
+        self.dirs_changes.update(
+            directory for directory in set(self.dirs) | set(dirs)
+            if self.dirs.get(directory) != dirs.get(directory)
+        )
+        self.dirs = dirs
         return (
             {entry.filename for entry in added},
             {entry.filename for entry in removed},
             {entry.filename for entry in content_modified},
         )
 
+    def refresh(self, relpaths):
+        """
+        Brings the entries for the given paths up to date with the
+        filesystem, without walking it: paths that no longer exist (or
+        aren't files or symlinks, other than to directories) are
+        removed, new ones are added, and changed ones are rehashed.
+
+        Paths that can't be read are reported on stderr and skipped,
+        keeping their entries as they were.
+
+        Returns a 3-tuple of sets of filenames, like update.
+        """
+        added, removed, modified = set(), set(), set()
+        to_hash = []
+        for relpath in relpaths:
+            if self.is_database_file(split_relpath(relpath)[1]):
+                continue
+            entry = self.entries.get(relpath)
+            try:
+                st = lstat(str(self.path / relpath))
+            except (FileNotFoundError, NotADirectoryError):
+                st = None
+            except OSError as e:
+                stderr.write('Could not read {}: {}\n'.format(self.path / relpath, e.strerror))
+                continue
+            # Like scan_tree, leave out symlinks to directories
+            if st is not None and S_ISLNK(st.st_mode) and os.path.isdir(str(self.path / relpath)):
+                st = None
+            if st is None or not (S_ISREG(st.st_mode) or S_ISLNK(st.st_mode)):
+                if entry is not None:
+                    self.remove_entry(entry)
+                    removed.add(entry.filename)
+                continue
+            if entry is None:
+                entry = HashEntry.from_relpath(self, relpath)
+            elif entry == st:
+                # e.g. only the permissions changed
+                continue
+            to_hash.append((entry, st))
+        if to_hash:
+            self.metrics.begin('Hashed', len(to_hash), sum(st.st_size for _, st in to_hash))
+        for (entry, _), (updated, hash_changed) in self.hash_entries(refresh_entry, to_hash):
+            self.metrics.file_done()
+            if isinstance(hash_changed, OSError):
+                stderr.write('Could not hash {}: {}\n'.format(entry.filename, hash_changed.strerror))
+            elif updated is None:
+                if entry.relpath in self.entries:
+                    self.remove_entry(entry)
+                    removed.add(entry.filename)
+            elif entry.relpath not in self.entries:
+                self.set_entry(updated)
+                added.add(updated.filename)
+            else:
+                self.set_entry(updated)
+                if hash_changed:
+                    modified.add(updated.filename)
+        self.metrics.end()
+        return added, removed, modified
+
+    def watch(self, debounce=2, reconcile_interval=3600):
+        """
+        Watches the tree with inotify, and keeps the database up to date
+        as files change. Events are collected per path, and a path is
+        refreshed once no new event arrived for it in debounce seconds,
+        so a file being written is hashed once, after the last write.
+
+        Starts with a full update, and repeats one every
+        reconcile_interval seconds (or when the kernel's event queue
+        overflows), to catch changes made while not watching or missed
+        for any other reason.
+
+        Errors on single paths, and full updates that fail, are reported
+        on stderr rather than stopping the watch; the next update retries
+        them. Only running out of inotify watches is fatal.
+
+        Runs forever, yielding a 3-tuple of sets of filenames, like
+        update, after each batch of changes.
+        """
+        inotify = Inotify()
+        # Watch descriptor -> relative path of the directory
+        watches = {}
+
+        def watch_tree(relpath):
+            """
+            Watches relpath and every directory below it, and returns
+            the relative paths of the files found
+            """
+            found = []
+            for parent, _, _, files in scan_tree(str(self.path / relpath)):
+                parent = join_relpath(relpath, parent) if parent else relpath
+                try:
+                    watches[inotify.add_watch(str(self.path / parent))] = parent
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    if e.errno == ENOSPC:
+                        raise
+                    stderr.write('Could not watch {}: {}\n'.format(self.path / parent, e.strerror))
+                    continue
+                found.extend(join_relpath(parent, f.name) for f in files)
+            return found
+
+        def entries_below(relpath):
+            for parent, names in list(self.entries.dirs.items()):
+                if parent == relpath or parent.startswith(relpath + sep):
+                    for name in names:
+                        yield join_relpath(parent, name)
+
+        def reconcile():
+            try:
+                return self.update()
+            except OSError as e:
+                stderr.write('Update failed, retrying in {} seconds: {}\n'.format(reconcile_interval, e))
+                return set(), set(), set()
+
+        try:
+            watch_tree('')
+            yield reconcile()
+            # Path -> time of its last event
+            pending = {}
+            next_reconcile = monotonic() + reconcile_interval
+            while True:
+                wake = next_reconcile
+                if pending:
+                    wake = min(wake, min(pending.values()) + debounce)
+                events = inotify.read(max(wake - monotonic(), 0))
+                now = monotonic()
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        next_reconcile = now
+                        continue
+                    parent = watches.get(wd)
+                    if parent is None or not name:
+                        if mask & IN_IGNORED:
+                            watches.pop(wd, None)
+                        continue
+                    relpath = join_relpath(parent, name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            paths = watch_tree(relpath)
+                        elif mask & (IN_DELETE | IN_MOVED_FROM):
+                            paths = list(entries_below(relpath))
+                            for other_wd, path in list(watches.items()):
+                                if path == relpath or path.startswith(relpath + sep):
+                                    del watches[other_wd]
+                                    inotify.rm_watch(other_wd)
+                        else:
+                            continue
+                        pending.update((path, now) for path in paths)
+                    elif not (parent == '' and self.is_database_file(name)):
+                        pending[relpath] = now
+                if now >= next_reconcile:
+                    pending.clear()
+                    watch_tree('')
+                    yield reconcile()
+                    next_reconcile = monotonic() + reconcile_interval
+                    continue
+                ready = [path for path, last_event in pending.items() if now - last_event >= debounce]
+                if ready:
+                    for path in ready:
+                        del pending[path]
+                    yield self.refresh(ready)
+        finally:
+            inotify.close()
+
+    def recover(self, directory: Path):
+        """
+        Matches the files below directory (e.g. lost+found after an
+        fsck) against the database by size and hash, to find where they
+        belong. Only files whose size matches an entry are read, and the
+        directory is streamed through the hashing workers rather than
+        listed up front, so this scales to huge numbers of files.
+
+        Yields a 3-tuple for each file:
+        [0] its path
+        [1] 'restore' if it matches an entry whose file is missing,
+            'present' if it only matches files that still exist, or
+            'unknown' if it matches nothing
+        [2] the entry to restore it as, for 'restore'
+        """
+        index = {}
+        for entry in self.entries.values():
+            # Empty files all look alike, so they can't be placed
+            if entry.type == HashEntryType.TYPE_FILE and entry.size and entry.digest is not None:
+                index.setdefault(entry.size, []).append(entry)
+        unknown = []
+
+        def candidates():
+            for parent, _, _, files in scan_tree(str(directory)):
+                for dir_entry in files:
+                    try:
+                        st = dir_entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if S_ISREG(st.st_mode) and st.st_size in index:
+                        yield dir_entry.path, st
+                    else:
+                        unknown.append(dir_entry.path)
+
+        worker = partial(match_recovered, index=index, algorithm=self.algorithm, reader=self.reader)
+        claimed = set()
+        for (path, _), matches in self.hash_entries(worker, candidates()):
+            while unknown:
+                yield unknown.pop(), 'unknown', None
+            if not matches:
+                yield path, 'unknown', None
+                continue
+            for entry in matches:
+                if entry.relpath not in claimed and not entry.exists():
+                    claimed.add(entry.relpath)
+                    yield path, 'restore', entry
+                    break
+            else:
+                yield path, 'present', None
+        while unknown:
+            yield unknown.pop(), 'unknown', None
+
     def status(self):
-        added, removed, modified = self._find_changes()
+        added, removed, modified, _ = self._find_changes()
         return (
             {entry.filename for entry in added},
             {entry.filename for entry in removed},
             {entry.filename for entry in modified},
         )
 
-    def verify(self, verbose_failures=False):
+    def verify(self, verbose_failures=False, mode='full', rolling=None, update_mtimes=False,
+               since=None, resume=False, checkpoint=None, checkpoint_interval=300):
         """
         Calls each HashEntry's verify method to make sure that
         nothing has changed on disk.
 
+        :param mode: one of VERIFY_MODES; 'quick' and 'sampled' only hash
+          the blocks chosen by sample_ranges
+        :param rolling: if given, only a 1/rolling slice of the entries
+          (chosen by path, and moving on each day) is fully verified. The
+          other entries are checked with mode, or skipped if mode is
+          'full', so every entry is fully verified once every rolling days.
+        :param update_mtimes: store the size and mtime on disk of each
+          entry that verifies successfully
+        :param since: skip entries fully verified within this many days
+        :param resume: skip entries fully verified since the start of the
+          last run, if that run didn't finish
+        :param checkpoint: called from this thread every checkpoint_interval
+          seconds and at the end, to save progress (e.g. self.save)
+
         Returns a 2-tuple of sets of filenames:
         [0] modified files
         [1] removed files
         """
         modified = set()
         removed = set()
-        count = len(self.entries)
-        # TODO: Track number of bytes hashed instead of number of files
-        # This will act as a more meaningful progress indicator
-        i = 0
-        for i, entry in enumerate(self.entries.values(), 1):
-            if entry.exists():
-                if entry.verify():
-                    entry.update_attrs()
-                else:
-                    #TODO add 'very verbose' option? would output size and mod date of file from hash DB and what is on disk. and expected and returned hash?
-                    if verbose_failures:
-                        stderr.write('\r{} failed hash verification\n'.format(entry.filename))
-                    modified.add(entry.filename)
-            else:
+        todays_slice = int(time() // 86400) % rolling if rolling else None
+        verified_after = None
+        if since is not None:
+            verified_after = time() - since * 86400
+        if resume and self.verify_started is not None:
+            verified_after = max(verified_after or 0, self.verify_started)
+        else:
+            self.verify_started = time()
+        items = []
+        for entry in self.entries.values():
+            if verified_after is not None and (entry.verified or 0) >= verified_after:
+                continue
+            entry_mode = mode
+            if rolling:
+                if crc32(fsencode(entry.relpath)) % rolling == todays_slice:
+                    entry_mode = 'full'
+                elif mode == 'full':
+                    continue
+            items.append((entry, entry_mode))
+        self.metrics.begin('Checked', len(items), sum(expected_bytes(*item) for item in items))
+        last_checkpoint = time()
+        results = self.hash_entries(partial(verify_entry, update_mtimes=update_mtimes), items)
+        for (entry, _), (result, changed) in results:
+            self.metrics.file_done()
+            if changed:
+                self.mark_changed(entry)
+            if result is None:
                 removed.add(entry.filename)
                 if verbose_failures:
                     stderr.write('\r{} is missing\n'.format(entry.filename))
-            stderr.write('\rChecked {} of {} files'.format(i, count))
-        if i:
-            stderr.write('\n')
+            elif not result:
+                #TODO add 'very verbose' option? would output size and mod date of file from hash DB and what is on disk. and expected and returned hash?
+                if verbose_failures:
+                    stderr.write('\r{} failed hash verification\n'.format(entry.filename))
+                modified.add(entry.filename)
+            if checkpoint is not None and time() - last_checkpoint >= checkpoint_interval:
+                checkpoint()
+                last_checkpoint = time()
+        self.metrics.end()
+        self.verify_started = None
+        if checkpoint is not None:
+            checkpoint()
         return modified, removed
 
-    def export(self):
+    def export(self, subdir: Path=None, per_directory=False, style='gnu', compress=False):
         """
         Exports the hash database in normal SHA512SUM format, usable as
-        input to `sha512sum -c`
+        input to `sha512sum -c`. Writes one file per algorithm, e.g.
+        SHA256SUM and SHA512SUM; entries without a digest for an
+        algorithm are left out of its file.
+
+        Entries are streamed in path order from EntryStore.sorted_entries,
+        which only sorts the names within each directory.
+
+        :param subdir: only export the entries below this directory, to
+          files in it, with paths relative to it
+        :param per_directory: write a file into every directory, listing
+          only the files directly in it
+        :param style: one of EXPORT_FORMATS; 'bsd' writes tagged lines
+          like `sha256sum --tag`
+        :param compress: write a gzip file of independently compressed
+          members, and an index of the first path in each (see
+          write_manifest)
 
-        Returns the number of entries exported.
+        Returns a dict of exported filename -> number of entries.
         """
-        hash_filename = self.path / HASH_FILENAME
-        i = 0
-        with hash_filename.open('wb') as f:
-            for i, name in enumerate(sorted(self.entries), 1):
-                entry = self.entries[name]
-                filename = str(entry.filename.relative_to(self.path))
-                line = entry.hash.encode('ascii') + b'  ' + fsencode(filename) + b'\n'
-                f.write(line)
-        return i
+        root = '' if subdir is None else self.relpath(subdir.absolute())
+        if root == '.':
+            root = ''
+        strip = len(root) + 1 if root else 0
+        counts = {}
+        for algorithm in self.algorithms:
+            if per_directory:
+                for directory in self.entries.subtree(root):
+                    names = self.entries.dirs.get(directory, {})
+                    entries = (names[name] for name in sorted(names))
+                    hash_filename = self.path / directory / algorithm.filename
+                    count = write_manifest(hash_filename, algorithm, entries, len(directory) + 1 if directory else 0,
+                                           style, compress)
+                    if count is not None:
+                        counts[hash_filename] = count
+            else:
+                hash_filename = self.path / root / algorithm.filename
+                entries = self.entries.sorted_entries(root)
+                counts[hash_filename] = write_manifest(hash_filename, algorithm, entries, strip, style, compress,
+                                                       keep_empty=True)
+        return counts
+
+def bsd_tag(algorithm: HashAlgorithm):
+    """
+    Returns the algorithm name used in BSD-style lines, as coreutils
+    writes them
+    """
+    if algorithm.name.startswith('blake2'):
+        return 'BLAKE2' + algorithm.name[6:]
+    return algorithm.name.upper()
+
+def write_manifest(filename: Path, algorithm: HashAlgorithm, entries, strip=0, style='gnu',
+                   compress=False, keep_empty=False):
+    """
+    Writes a line for each entry with a digest for algorithm, with the
+    first strip characters cut from its relative path.
+
+    With compress, writes filename + '.gz' as a series of gzip members
+    of about MANIFEST_MEMBER_SIZE uncompressed bytes each, which
+    together are still an ordinary gzip file, and filename + '.gz.idx',
+    a JSON list of [first path, offset, length] for each member, so
+    readers can decompress only the members covering the paths they
+    want.
+
+    Returns the number of lines written, or None if there were none and
+    keep_empty is false, in which case no file is written.
+    """
+    if style == 'bsd':
+        prefix = bsd_tag(algorithm).encode('ascii') + b' ('
+    count = 0
+    members = []
+    lines = []
+    pending = 0
+    first = None
+    f = None
+
+    def flush():
+        data = b''.join(lines)
+        if compress:
+            offset = f.tell()
+            f.write(gzip.compress(data))
+            members.append([first, offset, f.tell() - offset])
+        else:
+            f.write(data)
+        del lines[:]
+
+    try:
+        for entry in entries:
+            digest = entry.digest_for(algorithm)
+            if digest is None:
+                continue
+            if f is None:
+                f = filename.with_name(filename.name + '.gz').open('wb') if compress else filename.open('wb')
+            path = entry.relpath[strip:]
+            if first is None:
+                first = path
+            if style == 'bsd':
+                line = prefix + fsencode(path) + b') = ' + digest.hex().encode('ascii') + b'\n'
+            else:
+                line = digest.hex().encode('ascii') + b'  ' + fsencode(path) + b'\n'
+            lines.append(line)
+            count += 1
+            pending += len(line)
+            if pending >= MANIFEST_MEMBER_SIZE:
+                flush()
+                pending = 0
+                first = None
+        if f is None:
+            if not keep_empty:
+                return None
+            f = filename.with_name(filename.name + '.gz').open('wb') if compress else filename.open('wb')
+        if lines or (compress and not members):
+            flush()
+    finally:
+        if f is not None:
+            f.close()
+    if compress:
+        index = filename.with_name(filename.name + '.gz.idx')
+        with index.open('w') as f:
+            json.dump(members, f)
+    return count
+
+def find_duplicates(dbs, min_size=1, check_stale=False):
+    """
+    Finds files with identical contents across one or more databases,
+    comparing the primary algorithm of the first one.
+
+    Works as a funnel: entries are grouped by size, and files whose size
+    is unique are never read. Within a size, stored hashes are compared
+    directly. Entries without a usable stored hash -- from a database
+    using other algorithms, or with check_stale, files that changed
+    since they were hashed -- first get a digest of their first and last
+    MiB, and only those still matching another file are hashed in full.
+
+    :param check_stale: lstat every file, and don't trust the stored
+      hash of those whose size, mtime or type changed
+
+    Returns a list of lists of HashEntry objects with identical contents.
+    """
+    db = dbs[0]
+    algorithm = db.algorithm
+    sizes = {}
+    digests = {}
+    for other in dbs:
+        for entry in other.entries.values():
+            if entry.type != HashEntryType.TYPE_FILE:
+                continue
+            size = entry.size
+            digest = entry.digest_for(algorithm)
+            if check_stale:
+                try:
+                    st = lstat(str(entry.filename))
+                except OSError:
+                    continue
+                if entry != st:
+                    if not S_ISREG(st.st_mode):
+                        continue
+                    size = st.st_size
+                    digest = None
+            if size < min_size:
+                continue
+            sizes.setdefault(size, []).append(entry)
+            if digest is not None:
+                digests[entry] = digest
+
+    def hash_all(items):
+        if not items:
+            return
+        worker = partial(digest_entry, algorithm=algorithm, reader=db.reader)
+        db.metrics.begin('Hashed', len(items), sum(
+            entry.size if ranges is None else sum(length for _, length in ranges)
+            for entry, ranges in items
+        ))
+        for (entry, _), digest in db.hash_entries(worker, items):
+            db.metrics.file_done()
+            yield entry, digest
+        db.metrics.end()
+
+    # Sizes with a collision involving at least one unhashed entry
+    unknown_sizes = {
+        size: group for size, group in sizes.items()
+        if len(group) > 1 and any(entry not in digests for entry in group)
+    }
+    to_hash = []
+    quick_items = []
+    for size, group in unknown_sizes.items():
+        ranges = sample_ranges(size, 'quick')
+        if ranges is None:
+            # Small enough that the quick digest would be the full one
+            to_hash.extend((entry, None) for entry in group if entry not in digests)
+            continue
+        for entry in group:
+            if entry in digests and entry.db.algorithm == algorithm and entry.quick_digest is not None:
+                continue
+            quick_items.append((entry, ranges))
+    quick = {}
+    for entry, digest in hash_all(quick_items):
+        if digest is not None:
+            quick[entry] = digest
+    for size, group in unknown_sizes.items():
+        if sample_ranges(size, 'quick') is None:
+            continue
+        by_quick = {}
+        for entry in group:
+            digest = quick.get(entry)
+            if digest is None and entry in digests:
+                digest = entry.quick_digest
+            if digest is not None:
+                by_quick.setdefault(digest, []).append(entry)
+        for candidates in by_quick.values():
+            if len(candidates) > 1:
+                to_hash.extend((entry, None) for entry in candidates if entry not in digests)
+    for entry, digest in hash_all(to_hash):
+        if digest is not None:
+            digests[entry] = digest
+
+    groups = {}
+    for size, group in sizes.items():
+        if len(group) < 2:
+            continue
+        for entry in group:
+            digest = digests.get(entry)
+            if digest is not None:
+                groups.setdefault((size, digest), []).append(entry)
+    return [group for group in groups.values() if len(group) > 1]
 
 def print_file_list(files):
     for filename in sorted(files):
@@ -425,6 +2949,30 @@ def print_file_lists(added, removed, modified):
         print(MODIFIED_COLOR + 'Modified files:' + NO_COLOR)
         print_file_list(modified)
 
+def load_database(db):
+    """
+    Loads db for a command, exiting with a message if it can't be used,
+    e.g. because --algorithm doesn't match the one it was created with
+    """
+    try:
+        db.load()
+    except ValueError as e:
+        exit('{}. Stopping execution.'.format(e))
+
+def database_subdir(db, path: Path):
+    """
+    Returns path as a directory below db.path, exiting with a message if
+    it is outside the database or isn't a directory
+    """
+    # relpath also resolves '..', which Path.relative_to doesn't
+    relpath = os.path.relpath(str(path.absolute()), str(db.path))
+    if relpath == os.pardir or relpath.startswith(os.pardir + sep):
+        exit('{} is not inside {}. Stopping execution.'.format(path, db.path))
+    subdir = db.path / relpath
+    if not subdir.is_dir():
+        exit('{} is not a directory. Stopping execution.'.format(path))
+    return subdir
+
 
 ##
 ## Wrapper Functions, called by command line arguments
@@ -434,13 +2982,17 @@ def init(db, args):
     #TODO if allow relative data path to be stored in json file, then add switch here as to what version of db file to create. default to latest, but allow all. or just some?
     #TODO change to just checking for file existence? yup, fails if the file is not a hash db it can read. Is there a time when we care to specifically know that the file is a database, vs just that there is already a (any format) file named that?
     try:
-        db.load()
+        load_database(db)
         exit('Database exists, run update function instead. Stopping execution.')
         #exit('Filename exists, run update or status function instead. Stopping execution.')
     except FileNotFoundError:
         print('Initializing hash database')
 
-    added, removed, modified = db.update()
+    added, removed, modified = db.update(
+        checkpoint=None if args.pretend else db.save,
+        checkpoint_interval=args.checkpoint_interval,
+    )
+    db.metrics.results.update(added=len(added), removed=len(removed), modified=len(modified))
     if args.verbose:
         print_file_lists(added, removed, modified)
     if not args.pretend:
@@ -448,15 +3000,19 @@ def init(db, args):
 
 def update(db, args):
     print('Updating hash database')
-    db.load()
-    added, removed, modified = db.update()
+    load_database(db)
+    added, removed, modified = db.update(
+        checkpoint=None if args.pretend else db.save,
+        checkpoint_interval=args.checkpoint_interval,
+    )
+    db.metrics.results.update(added=len(added), removed=len(removed), modified=len(modified))
     if args.verbose:
         print_file_lists(added, removed, modified)
     if not args.pretend:
         db.save()
 
 def status(db, args):
-    db.load()
+    load_database(db)
     added, removed, modified = db.status()
     print_file_lists(added, removed, modified)
 
@@ -464,38 +3020,215 @@ def import_hashes(db, args):
     #TODO this could be borked if importing sha256sum and a hashdb with sha512 hashes. or would the hash just be read later as 'not matching' and recomputed?
     print('Importing hashes')
     overall_count = 0
-    for import_filename in find_external_hash_files(Path().absolute()):
-        if import_filename.name == args.jsondb:
-            #TODO why would you use this import function on a json hash db?
-            temp_db = HashDatabase(import_filename.parent)
+    if args.files or args.files_from:
+        import_filenames = [path.absolute() for path in args.files]
+        if args.files_from:
+            try:
+                with (stdin if args.files_from == '-' else open(args.files_from)) as f:
+                    import_filenames.extend(Path(line.rstrip('\n')).absolute() for line in f if line.strip())
+            except OSError as e:
+                exit('Could not read {}: {}. Stopping execution.'.format(args.files_from, e.strerror))
+        missing = [str(path) for path in import_filenames if not path.is_file()]
+        if missing:
+            exit('Hash files not found: {}. Stopping execution.'.format(', '.join(missing)))
+    else:
+        patterns = import_filename_patterns(db.algorithm)
+        import_filenames = find_external_hash_files(Path().absolute(), patterns)
+    hash_files = []
+    for import_filename in import_filenames:
+        if import_filename.name != args.jsondb:
+            hash_files.append(import_filename)
+            continue
+        #TODO why would you use this import function on a json hash db?
+        temp_db = HashDatabase(args, import_filename.parent)
+        try:
             temp_db.load()
-            count = len(temp_db.entries)
-            db.entries.update(temp_db.entries)
-        else:
-            count = db.import_hashes(import_filename)
+        except ValueError as e:
+            print('Skipping {}: {}'.format(import_filename, e))
+            continue
+        if temp_db.algorithm != db.algorithm:
+            print('Skipping {}: uses {}, not {}'.format(import_filename, temp_db.algorithm.name, db.algorithm.name))
+            continue
+        prefix = db.relpath(temp_db.path)
+        count = db.copy_subtree(temp_db, '', '' if prefix == '.' else prefix)
         overall_count += count
         print('Imported {} entries from {}'.format(count, import_filename))
+    try:
+        for import_filename, count, skipped in db.import_hashes(hash_files):
+            overall_count += count
+            print('Imported {} entries from {}'.format(count, import_filename))
+            if skipped:
+                print('Skipped {} entries outside {}:'.format(len(skipped), db.path))
+                for filename in skipped:
+                    print('  {}'.format(filename))
+    except OSError as e:
+        exit('Could not read {}: {}. Stopping execution.'.format(e.filename, e.strerror))
+    db.metrics.results.update(imported=overall_count)
     print('\nImported {} total entries'.format(overall_count))
     if not args.pretend:
         db.save()
 
 def verify(db, args):
-    db.load()
-    modified, removed = db.verify(args.verbose_failures)
+    load_database(db)
+    modified, removed = db.verify(
+        args.verbose_failures,
+        args.mode,
+        args.rolling,
+        update_mtimes=args.update_mtimes,
+        since=args.since,
+        resume=args.resume,
+        checkpoint=None if args.pretend else db.save,
+        checkpoint_interval=args.checkpoint_interval,
+    )
+    db.metrics.results.update(modified=len(modified), removed=len(removed))
     print_file_lists(None, removed, modified)
-    if args.update_mtimes and not args.pretend:
-        db.save()
+
+def watch(db, args):
+    try:
+        load_database(db)
+    except FileNotFoundError:
+        print('Initializing hash database')
+    print('Watching {}'.format(db.path))
+    try:
+        for added, removed, modified in db.watch(args.debounce, args.reconcile_interval):
+            if args.verbose:
+                print_file_lists(added, removed, modified)
+            if not args.pretend and (db.changed is None or db.changed or db.deleted):
+                db.save()
+    except OSError as e:
+        if e.errno == ENOSPC:
+            exit('Out of inotify watches; raise fs.inotify.max_user_watches. Stopping execution.')
+        raise
+    except KeyboardInterrupt:
+        pass
+
+def dupes(db, args):
+    load_database(db)
+    dbs = [db]
+    for path in args.databases:
+        other = HashDatabase(args, path)
+        try:
+            other.load()
+        except (FileNotFoundError, ValueError) as e:
+            exit('Could not load the database for {}: {}'.format(path, e))
+        dbs.append(other)
+    groups = find_duplicates(dbs, args.min_size, args.check_stale)
+    # Largest savings first
+    groups.sort(key=lambda group: (-group[0].size * (len(group) - 1), str(group[0].filename)))
+    files = reclaimable = 0
+    for group in groups:
+        # Hardlinks to the same inode don't take up extra space
+        inodes = {(entry.dev, entry.ino) if entry.ino is not None else entry for entry in group}
+        files += len(group) - 1
+        reclaimable += group[0].size * (len(inodes) - 1)
+        print('{} files of {}:'.format(len(group), format_size(group[0].size)))
+        print_file_list(entry.filename for entry in group)
+    db.metrics.results.update(duplicate=files)
+    print('{} duplicate files in {} groups, {} reclaimable'.format(files, len(groups), format_size(reclaimable)))
+
+def recover(db, args):
+    load_database(db)
+    counts = dict.fromkeys(['restore', 'present', 'unknown'], 0)
+    for path, result, entry in db.recover(args.directory):
+        counts[result] += 1
+        if result == 'unknown':
+            if args.verbose:
+                print('No match for {}'.format(path))
+            continue
+        if result == 'present':
+            if args.verbose:
+                print('{} is a copy of an existing file'.format(path))
+            continue
+        print('{} -> {}'.format(path, entry.filename))
+        if args.execute and not args.pretend:
+            # Both checked just before: claimed by nothing else, and missing
+            entry.filename.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(path, str(entry.filename))
+    db.metrics.results.update(counts)
+    print('{} files {}, {} copies of existing files, {} unmatched'.format(
+        counts['restore'], 'restored' if args.execute and not args.pretend else 'to restore',
+        counts['present'], counts['unknown']))
 
 def split(db, args):
-    db.load()
-    new_db = db.split(args.subdir)
+    load_database(db)
+    new_db = db.split(database_subdir(db, args.subdir))
     new_db.save()
     print('Wrote {} hash entries to {}'.format(len(new_db.entries), new_db.path / args.jsondb))
 
+def compare(db, args):
+    load_database(db)
+    other = HashDatabase(args, db.path)
+    try:
+        other.load(Path(args.other), upgrade=False)
+        only_here, only_there, different = db.compare(other)
+    except (FileNotFoundError, ValueError) as e:
+        exit('Can not compare with {}: {}'.format(args.other, e))
+    source = 'standard input' if args.other == '-' else args.other
+    for title, color, relpaths in [
+        ('Only in {}:'.format(db.path / args.jsondb), REMOVED_COLOR, only_here),
+        ('Only in {}:'.format(source), ADDED_COLOR, only_there),
+        ('Different:', MODIFIED_COLOR, different),
+    ]:
+        if relpaths:
+            print(color + title + NO_COLOR)
+            print_file_list(relpaths)
+    db.metrics.results.update(only_here=len(only_here), only_there=len(only_there), different=len(different))
+    if only_here or only_there or different:
+        exit(1)
+    print('Databases match')
+
+def merge(db, args):
+    try:
+        load_database(db)
+        new = False
+    except FileNotFoundError:
+        print('Initializing hash database')
+        new = True
+    total = 0
+    for path in args.databases:
+        if not (path / args.jsondb).is_file():
+            exit('No {} in {}. Stopping execution.'.format(args.jsondb, path))
+        other = HashDatabase(args, path)
+        try:
+            other.load()
+            prefix = db.relpath(other.path)
+        except ValueError as e:
+            exit('Can not merge {}: {}'.format(path, e))
+        if new and args.algorithm is None:
+            # A new database takes the algorithms of the first one merged
+            db.algorithms = other.algorithms
+            new = False
+        if other.algorithm != db.algorithm:
+            exit('Can not merge {}: uses {}, not {}'.format(path, other.algorithm.name, db.algorithm.name))
+        count = db.copy_subtree(other, '', '' if prefix == '.' else prefix)
+        total += count
+        print('Merged {} hash entries from {}'.format(count, other.path / args.jsondb))
+    db.metrics.results.update(merged=total)
+    if not args.pretend:
+        db.save()
+
+def migrate(db, args):
+    load_database(db)
+    filename = db.path / args.output
+    if filename.exists():
+        exit('{} already exists. Stopping execution.'.format(filename))
+    # Write every entry, whatever was loaded
+    db.changed = None
+    if not args.pretend:
+        db.save(filename)
+    print('Wrote {} hash entries to {}'.format(len(db.entries), filename))
+
 def export(db, args):
-    db.load()
-    count = db.export()
-    print('Exported {} entries to {}'.format(count, db.path / HASH_FILENAME))
+    load_database(db)
+    subdir = None if args.subdir is None else database_subdir(db, args.subdir)
+    counts = db.export(subdir, args.per_directory, args.format, args.compress)
+    if args.per_directory:
+        print('Exported {} entries to {} files'.format(sum(counts.values()), len(counts)))
+        return
+    for hash_filename, count in counts.items():
+        if args.compress:
+            hash_filename = hash_filename.with_name(hash_filename.name + '.gz')
+        print('Exported {} entries to {}'.format(count, hash_filename))
 
 if __name__ == '__main__':
     parser = ArgumentParser()
@@ -504,22 +3237,60 @@ if __name__ == '__main__':
     #TODO maybe change pretend to dry-run if it continues to trip me up when I read it
     parser.add_argument('-n', '--pretend', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--trust-dir-mtimes', action='store_true', help=('Skip '
+        'checking files in directories whose mtime and number of entries are unchanged '
+        'since the last update. Much faster on mostly static trees, but misses files '
+        'modified in place.'))
+    parser.add_argument('-a', '--algorithm', type=parse_algorithms, help=('Hash algorithm, '
+        'or comma-separated list of algorithms computed in the same pass over each file, '
+        'for a new database. The first is used to detect changes and verify files. Must '
+        'match the database for existing ones. Default: {}; available: {}'.format(
+            DEFAULT_HASH_ALGORITHM, ', '.join(sorted(HASH_FUNCTIONS)))))
+    parser.add_argument('--read-strategy', choices=READ_STRATEGIES, default='readinto', help=(
+        'How file contents are read for hashing: readinto reads into a reused buffer; '
+        'fadvise also drops hashed data from the page cache; direct bypasses the page '
+        'cache with O_DIRECT; mmap maps each file. Default: readinto'))
+    parser.add_argument('--chunk-size', type=parse_size, default=CHUNK_SIZE, help=('Bytes '
+        'read and hashed at a time, e.g. 4M. Default: 16M'))
+    parser.add_argument('--readahead', type=parse_size, default=0, help=('Ask the kernel '
+        'to prefetch this many bytes past the chunk being hashed. Default: 0 (kernel '
+        'default read-ahead)'))
+    parser.add_argument('--max-bytes-per-sec', type=parse_size, help=('Limit the rate '
+        'at which file contents are read by update, verify and import, e.g. 50M'))
+    parser.add_argument('--max-files-per-sec', type=float, help=('Limit the number of '
+        'files opened (or stat\'ed by import) per second'))
+    parser.add_argument('--adaptive-throttle', action='store_true', help=('Slow down '
+        'further while read latency is rising, to yield the disks to other workloads'))
+    parser.add_argument('--metrics-file', type=Path, help=('At the end of the command, '
+        'write a summary of files and bytes hashed, throughput and time spent reading '
+        'and hashing to this file: a Prometheus textfile if it ends in .prom, '
+        'otherwise JSON'))
+    parser.add_argument('-J', '--jobs', type=int, default=1, help=('Number of files to '
+        'hash concurrently. Default: 1'))
     parser.add_argument('-j', '--jsondb', help='JSON database file. Default: {}'.format(DB_DEFAULT_FILENAME), default=DB_DEFAULT_FILENAME)
     #TODO change -jsondb to a full path, not sure why you would want to go searching in the provided path and parent directories for a hash db... if you run it and your getcwd() is a subdir of where the database is, it still verifies/whatever all files in the database (not just those in cwd). not sure if I'm just missing the purpose so not changing yet
     #TODO hmm but allowing a full path for json db file then really opens up the need to check that the json hash db file is matched with the right data dir. If you run update on a hash db and point it to the wrong data dir, it will just list all files in db as removed, and all files in the (incorrect) data-dir as added... which could happen anyway if you move the json hash db, but maybe less likely??
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(dest='command')
 
     parser_init = subparsers.add_parser('init')
+    parser_init.add_argument('--checkpoint-interval', type=float, default=300, metavar='SECONDS',
+        help=('Save hashing progress this often. Default: 300'))
     parser_init.set_defaults(func=init)
 
     parser_update = subparsers.add_parser('update')
+    parser_update.add_argument('--checkpoint-interval', type=float, default=300, metavar='SECONDS',
+        help=('Save hashing progress this often. Default: 300'))
     parser_update.set_defaults(func=update)
 
     parser_status = subparsers.add_parser('status')
     parser_status.set_defaults(func=status)
 
     parser_import = subparsers.add_parser('import')
-    #TODO change to require that you specify path to import file. fails if hash database. can then remove IMPORT_FILENAME_PATTERNS
+    parser_import.add_argument('files', nargs='*', type=Path, help=('Hash files to '
+        'import. Default: every file below the current directory matching the '
+        'import patterns'))
+    parser_import.add_argument('--files-from', metavar='LIST', help=('Also import the '
+        'hash files named in LIST, one per line, or - for standard input'))
     parser_import.set_defaults(func=import_hashes)
 
     parser_verify = subparsers.add_parser('verify')
@@ -529,14 +3300,86 @@ if __name__ == '__main__':
     parser_verify.add_argument('--update-mtimes', action='store_true', help=('If hash '
         'verification of a file succeeds, update its stored modification time to match '
         'that of the file on disk.'))
+    parser_verify.add_argument('--mode', choices=VERIFY_MODES, default='full', help=('full '
+        'hashes every byte; quick hashes only the first and last MiB of each file, and '
+        'sampled a set of blocks spread over the file, comparing against partial hashes '
+        'stored by update. Default: full'))
+    parser_verify.add_argument('--rolling', type=int, metavar='N', help=('Fully verify '
+        'a different 1/N of the entries each day, and check the rest with --mode (or '
+        'skip them, if --mode is full). Running this daily fully verifies every file '
+        'every N days.'))
+    parser_verify.add_argument('--since', type=float, metavar='DAYS', help=('Skip '
+        'entries that were fully verified within the last DAYS days.'))
+    parser_verify.add_argument('--resume', action='store_true', help=('Continue an '
+        'interrupted verify: skip entries fully verified since that run started.'))
+    parser_verify.add_argument('--checkpoint-interval', type=float, default=300, metavar='SECONDS',
+        help=('Save verification progress this often. Default: 300'))
     parser_verify.set_defaults(func=verify)
 
+    parser_watch = subparsers.add_parser('watch', help=('Keep the database up to date '
+        'as files change, using inotify (Linux only)'))
+    parser_watch.add_argument('--debounce', type=float, default=2, metavar='SECONDS',
+        help=('Rehash a file once it has had no events for this long. Default: 2'))
+    parser_watch.add_argument('--reconcile-interval', type=float, default=3600, metavar='SECONDS',
+        help=('Run a full update this often, to catch missed events. Default: 3600'))
+    parser_watch.set_defaults(func=watch)
+
+    parser_dupes = subparsers.add_parser('dupes', help=('List files with identical '
+        'contents, using the stored hashes'))
+    parser_dupes.add_argument('databases', nargs='*', type=Path, metavar='DATA_DIR', help=(
+        'Data directories of other databases (with the same --jsondb name) to look for '
+        'duplicates in as well'))
+    parser_dupes.add_argument('--min-size', type=parse_size, default=1, help=('Ignore '
+        'files smaller than this. Default: 1, i.e. skip empty files'))
+    parser_dupes.add_argument('--check-stale', action='store_true', help=('Check each '
+        'file on disk, and rehash (only as needed) those changed since they were hashed'))
+    parser_dupes.set_defaults(func=dupes)
+
+    parser_recover = subparsers.add_parser('recover', help=('Find where the files in '
+        'a directory such as lost+found belong, by their size and hash'))
+    parser_recover.add_argument('directory', type=Path)
+    parser_recover.add_argument('--execute', action='store_true', help=('Move matched '
+        'files back into place, instead of only listing the moves'))
+    parser_recover.set_defaults(func=recover)
+
     parser_split = subparsers.add_parser('split')
     parser_split.add_argument('subdir', type=Path)
     parser_split.set_defaults(func=split)
 
+    parser_compare = subparsers.add_parser('compare', help=('Compare with another '
+        'database of the same tree, e.g. of a replica, descending only into '
+        'directories whose digests differ'))
+    parser_compare.add_argument('other', help=('Database file to compare with (JSON or '
+        'SQLite), or - to read a JSON database, followed by its journal if it has '
+        'one, from standard input, e.g. "ssh replica \'cat /data/hash_db.json '
+        '/data/hash_db.json-journal 2>/dev/null\' | hash_db.py -d /data compare -"'))
+    parser_compare.set_defaults(func=compare)
+
+    parser_merge = subparsers.add_parser('merge', help=('Copy the entries of databases '
+        'in subdirectories into this one, e.g. to undo a split'))
+    parser_merge.add_argument('databases', nargs='+', type=Path, metavar='DATA_DIR', help=(
+        'Directories below the data directory holding a database (with the same '
+        '--jsondb name)'))
+    parser_merge.set_defaults(func=merge)
+
+    parser_migrate = subparsers.add_parser('migrate')
+    parser_migrate.add_argument('output', help=('Filename of the new database, in the same '
+        'directory as the current one. Names ending in {} use SQLite, anything else '
+        'JSON.'.format(', '.join(SQLITE_SUFFIXES))))
+    parser_migrate.set_defaults(func=migrate)
+
     parser_export = subparsers.add_parser('export')
     #TODO add ability to optionally specify output path
+    parser_export.add_argument('--subdir', type=Path, help=('Only export the entries '
+        'below this directory, to a file in it with paths relative to it'))
+    parser_export.add_argument('--per-directory', action='store_true', help=('Write a '
+        'file into each directory, listing the files directly in it'))
+    parser_export.add_argument('--format', choices=EXPORT_FORMATS, default='gnu', help=(
+        'gnu: "HASH  PATH" lines; bsd: tagged "SHA256 (PATH) = HASH" lines, as '
+        'written by sha256sum --tag. Both work with sha256sum -c. Default: gnu'))
+    parser_export.add_argument('--compress', action='store_true', help=('Write gzip '
+        'files, made of independently compressed blocks listed in an index file '
+        '(NAME.gz.idx) with the first path in each'))
     parser_export.set_defaults(func=export)
 
     args = parser.parse_args()
@@ -549,3 +3392,5 @@ if __name__ == '__main__':
     #FIXME remove extra path passage, and just use args.data_dir everywhere
     db = HashDatabase(args, args.data_dir)
     args.func(db, args)
+    if args.metrics_file is not None:
+        db.metrics.write(args.metrics_file, args.command)